@@ -0,0 +1,84 @@
+import time
+from array import array
+from machine import Pin
+from micropython import const
+
+#events returned by Button.poll
+PRESS = const(1)
+LONG_PRESS = const(2)
+RELEASE = const(3)
+
+DEBOUNCE_MS = const(30)
+LONG_PRESS_MS = const(500)
+EDGES = const(16)
+
+
+class Button:
+    """Active low push button read from pin interrupts.
+
+    The irq handler only stores the time and the level of each edge in
+    preallocated buffers, poll() turns them into events afterwards. An edge
+    is taken into account once the pin stayed quiet DEBOUNCE_MS after it,
+    press and release times are the ones of the first edge of the bounce,
+    so the events do not depend on how late poll() is called.
+    """
+
+    def __init__(self, pin_no):
+        self.pin = Pin(pin_no, Pin.IN, Pin.PULL_UP)
+        self.times = array("i", [0] * EDGES)
+        self.levels = bytearray(EDGES)
+        self.head = 0
+        self.tail = 0
+        self.bounce_start = None
+        self.pressed = False
+        self.long = False
+        self.press_time = 0
+        self.pin.irq(handler=self.edge, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
+
+    def edge(self, pin):
+        idx = self.head
+        nxt = (idx + 1) % EDGES
+        if nxt == self.tail:
+            #buffer full, the last edge is overwritten to keep the final level
+            idx = (idx - 1) % EDGES
+            nxt = self.head
+        self.times[idx] = time.ticks_ms()
+        self.levels[idx] = pin.value()
+        self.head = nxt
+
+    def poll(self):
+        """Returns the next PRESS, LONG_PRESS or RELEASE event, 0 if there is none."""
+        if self.tail == self.head and not self.pressed:
+            return 0
+        now = time.ticks_ms()
+        while self.tail != self.head:
+            idx = self.tail
+            nxt = (idx + 1) % EDGES
+            edge_time = self.times[idx]
+            if nxt != self.head:
+                stable = time.ticks_diff(self.times[nxt], edge_time) >= DEBOUNCE_MS
+            elif time.ticks_diff(now, edge_time) >= DEBOUNCE_MS:
+                stable = True
+            else:
+                #still bouncing
+                return 0
+            if self.bounce_start is None:
+                self.bounce_start = edge_time
+            self.tail = nxt
+            if stable:
+                start = self.bounce_start
+                self.bounce_start = None
+                pressed = self.levels[idx] == 0
+                if pressed != self.pressed:
+                    self.pressed = pressed
+                    if pressed:
+                        self.long = False
+                        self.press_time = start
+                        return PRESS
+                    #a long press may have ended before being polled
+                    self.long |= time.ticks_diff(start, self.press_time) >= LONG_PRESS_MS
+                    return RELEASE
+        if self.pressed and not self.long and time.ticks_diff(now, self.press_time) >= LONG_PRESS_MS:
+            self.long = True
+            return LONG_PRESS
+        return 0
@@ -0,0 +1,114 @@
+import time
+import usocket
+from machine import RTC
+
+import eventlog
+from eventlog import EPOCH_OFFSET
+
+#seconds from 1900-01-01 (NTP) to the Unix epoch
+UNIX_DELTA = 2208988800
+#time allowed for the server answer, polled every POLL_MS
+TIMEOUT_MS = 1000
+POLL_MS = 2
+#delay before a new request after a failure, and between two synchronisations
+RETRY_MS = 10000
+RESYNC_MS = 24*3600*1000
+#with groups: a crystal drifting by a few tens of ppm stays within a fade frame
+GROUP_RESYNC_MS = 5*60*1000
+
+
+def unix_ms(answer, pos):
+    """Unix time (ms) of the NTP timestamp at pos in the answer."""
+    return (int.from_bytes(answer[pos:pos + 4], "big") - UNIX_DELTA)*1000 + (int.from_bytes(answer[pos + 4:pos + 8], "big")*1000 >> 32)
+
+
+class Clock:
+    """Sets the RTC from an SNTP server without blocking the loop.
+
+    step() sends the request on a non blocking UDP socket and returns
+    POLL_MS, the scheduler then runs it again that soon until the answer is
+    read. A request without answer within TIMEOUT_MS is sent again RETRY_MS
+    later. Once set the clock is synchronised again every resync_ms.
+    on_sync is called after each synchronisation.
+
+    The server time at the answer reading is its transmit time plus half of
+    the round trip, less the time the server held the request. It is kept
+    in Unix ms with the ticks_ms of the reading, delay_to() gives the ms
+    left until a Unix time from them.
+    """
+
+    def __init__(self, host, on_sync=None, resync_ms=RESYNC_MS):
+        self.host = host
+        self.on_sync = on_sync
+        self.resync_ms = resync_ms
+        self.addr = None
+        self.sock = None
+        self.sent = 0
+        self.due = time.ticks_ms()
+        self.synced = False
+        self.unix_ms = 0
+        self.ticks = 0
+        self.request = bytearray(48)
+        self.request[0] = 0x1B #client, version 3
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+
+    def step(self):
+        """Returns POLL_MS while an answer is awaited."""
+        now = time.ticks_ms()
+        if self.sock:
+            try:
+                answer = self.sock.recv(48)
+            except OSError:
+                #EAGAIN, not answered yet
+                answer = None
+            if answer and len(answer) == 48:
+                self.close()
+                #receive and transmit timestamps of the server
+                held = unix_ms(answer, 40) - unix_ms(answer, 32)
+                self.unix_ms = unix_ms(answer, 40) + max(time.ticks_diff(now, self.sent) - held, 0)//2
+                self.ticks = now
+                self.set(self.unix_ms//1000 - EPOCH_OFFSET)
+                self.due = time.ticks_add(now, self.resync_ms)
+            elif time.ticks_diff(now, self.sent) > TIMEOUT_MS:
+                self.close()
+                self.due = time.ticks_add(now, RETRY_MS)
+            else:
+                return POLL_MS
+            return
+        if time.ticks_diff(now, self.due) < 0:
+            return
+        try:
+            if not self.addr:
+                #the only blocking call, made once
+                self.addr = usocket.getaddrinfo(self.host, 123)[0][-1]
+            self.sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.sock.sendto(self.request, self.addr)
+            self.sent = time.ticks_ms()
+            return POLL_MS
+        except OSError as excp:
+            eventlog.warning("NTP request failed {}", excp)
+            if self.sock:
+                self.close()
+            self.due = time.ticks_add(now, RETRY_MS)
+
+    def set(self, seconds):
+        tm = time.gmtime(seconds)
+        RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        self.synced = True
+        if self.on_sync:
+            self.on_sync()
+
+    def delay_to(self, unix_ms):
+        """ms from now to the Unix time unix_ms (negative when past), None until synchronised.
+
+        A plain int, far away times do not overflow the ticks_ms range."""
+        if not self.synced:
+            return None
+        return unix_ms - (self.unix_ms + time.ticks_diff(time.ticks_ms(), self.ticks))
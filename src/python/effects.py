@@ -0,0 +1,72 @@
+import math
+from array import array
+from micropython import const
+
+#effect is given by the tens of the cycler value, speed by the units
+CYCLE = const(0)
+RAINBOW = const(1)
+BREATHE = const(2)
+EFFECTS = const(3)
+
+FRAME_MS = const(40)
+
+#duty (0..1022) of a cosine over 256 steps, phases are 16 bits (index is the high byte)
+COS_LUT = array("H", [int(511 * math.cos(2 * math.pi * i / 256) + 511) for i in range(256)])
+
+#phase increments per 50 ms at speed 1, were pi/180, pi/270 and pi/225 rad
+CYCLE_STEPS = (182, 121, 146)
+THIRD = const(21845)
+
+
+class Effects:
+    """Colour effects computed with 16 bits phase accumulators and COS_LUT.
+
+    frame() is meant to be called every FRAME_MS, it does not allocate.
+    * CYCLE: each channel follows a cosine with its own period
+    * RAINBOW: channels follow the same cosine 120 degrees apart
+    * BREATHE: the colour shown when the effect starts fades in and out
+    """
+
+    def __init__(self, pwms):
+        self.pwms = pwms
+        self.phases = array("H", [0] * len(pwms))
+        self.steps = array("H", [0] * len(pwms))
+        self.base = array("H", [0] * len(pwms))
+        self.effect = CYCLE
+
+    def select(self, value):
+        """Starts the effect encoded in cycler value, returns False if value is invalid."""
+        if not 0 < value < EFFECTS * 10:
+            return False
+        effect, speed = divmod(value, 10)
+        speed = speed or 1
+        self.effect = effect
+        for idx, pwm in enumerate(self.pwms):
+            self.steps[idx] = CYCLE_STEPS[idx % 3] * speed * FRAME_MS // 50 & 0xFFFF
+            #cosine starts at its minimum
+            self.phases[idx] = 0x8000
+            self.base[idx] = pwm.duty()
+        if effect == RAINBOW:
+            for idx in range(len(self.pwms)):
+                self.steps[idx] = self.steps[0]
+                self.phases[idx] = (0x8000 + idx * THIRD) & 0xFFFF
+        elif effect == BREATHE:
+            if not any(self.base):
+                for idx in range(len(self.pwms)):
+                    self.base[idx] = 1023
+        return True
+
+    def frame(self):
+        phases = self.phases
+        steps = self.steps
+        lut = COS_LUT
+        if self.effect == BREATHE:
+            level = lut[phases[0] >> 8]
+            phases[0] = (phases[0] + steps[0]) & 0xFFFF
+            for idx in range(len(phases)):
+                self.pwms[idx].duty(self.base[idx] * level >> 10)
+        else:
+            for idx in range(len(phases)):
+                phase = phases[idx]
+                self.pwms[idx].duty(lut[phase >> 8])
+                phases[idx] = (phase + steps[idx]) & 0xFFFF
@@ -1,72 +1,160 @@
+import time
+from micropython import const
+
 import homie
-import dht
+import eventlog
+from scheduler import RESTART_MIN_MS, RESTART_MAX_MS
+
+#every sensor is measured once per period (default), the sensors are spread over it
+PERIOD_MS = const(60000)
+#time allowed for a measurement on top of the conversion time
+DEADLINE_MS = const(1000)
+ETIMEDOUT = const(110)
 
 class EnironmentNode(homie.Node):
+    """Sensor node measured in two phases by SensorScheduler: start() begins a
+    conversion, collect() reads and publishes the result CONVERSION_MS later.
+
+    A measurement failing (or collected after its deadline) is retried
+    RETRY_MS later up to RETRIES times, then the node raises an alert and
+    waits for its next period.
+    """
+    CONVERSION_MS = 0
+    RETRIES = 0
+    RETRY_MS = 4000
+    ERRORS = (OSError,)
+
     def __init__(self, props, num):
         ext = ""
         if num:
             ext = str(num)
         super().__init__("environment"+ext, "Environment Measures", props)
+        self.collecting = False
+        self.errors = 0
+        self.cycle = self.due = self.started = 0
+        self.period = PERIOD_MS
+        #delay before measuring again after an unexpected exception (a driver bug)
+        self.backoff = RESTART_MIN_MS
 
     def get_temp_prop(self):
-        return homie.Property("temperature", "Temperature", "float", "°C".encode("utf-8"), None, 0)
+        return homie.Property("temperature", "Temperature", "float", "°C".encode("utf-8"), None, 0, decimals=1)
 
     def get_humid_prop(self):
-        return homie.Property("humidity", "Humidity", "float", "%", "0:100", 0)
+        return homie.Property("humidity", "Humidity", "float", "%", "0:100", 0, decimals=1)
 
     def get_press_prop(self):
-        return homie.Property("pressure", "Atmospheric pressure", "float", "mBar", None, 0)
+        return homie.Property("pressure", "Atmospheric pressure", "float", "mBar", None, 0, decimals=2)
+
+    def start(self):
+        """Begins the conversion, nothing to do for sensors measured in collect()."""
+        pass
+
+    def collect(self):
+        """Reads the measure and reports it on the properties, done by each sensor."""
+        pass
+
+    def fault(self, now, excp):
+        """Unexpected exception of a measurement: the node alone waits, longer after each fault."""
+        eventlog.error("{} fault, measured again in {} ms: {!r}", self.__class__.__name__, self.backoff, excp)
+        self.collecting = False
+        self.due = time.ticks_add(now, self.backoff)
+        self.backoff = min(self.backoff * 2, RESTART_MAX_MS)
+
+    def step(self, now):
+        """Runs the next phase of the measurement, self.due is then the time of the following one."""
+        try:
+            if not self.collecting:
+                self.start()
+                self.started = now
+                self.collecting = True
+                self.due = time.ticks_add(now, self.CONVERSION_MS)
+                return
+            self.collecting = False
+            if time.ticks_diff(now, self.started) > self.CONVERSION_MS + DEADLINE_MS:
+                raise OSError(ETIMEDOUT)
+            self.collect()
+        except self.ERRORS as excp:
+            self.collecting = False
+            self.errors += 1
+            if self.errors <= self.RETRIES:
+                eventlog.warning("{} error {}, retrying", self.__class__.__name__, excp)
+                self.due = time.ticks_add(now, self.RETRY_MS)
+                return
+            #too many retries
+            self.properties[0].alert()
+        self.errors = 0
+        self.backoff = RESTART_MIN_MS
+        self.cycle = time.ticks_add(self.cycle, self.period)
+        if time.ticks_diff(self.cycle, now) < 0:
+            #the loop was stalled for more than a period
+            self.cycle = now
+        self.due = self.cycle
+
+class SensorScheduler:
+    """Spreads the measurements of the sensor nodes evenly over period_ms and
+    runs at most one measurement phase per call, so the I/O of two sensors
+    never lands in the same loop iteration. A node raising an unexpected
+    exception is set aside with a backoff delay, the others go on."""
+
+    def __init__(self, nodes, period_ms=PERIOD_MS):
+        self.nodes = nodes
+        now = time.ticks_ms()
+        for idx, node in enumerate(nodes):
+            node.period = period_ms
+            node.cycle = node.due = time.ticks_add(now, idx*period_ms//len(nodes))
+
+    def run(self):
+        now = time.ticks_ms()
+        for node in self.nodes:
+            if time.ticks_diff(now, node.due) >= 0:
+                try:
+                    node.step(now)
+                except Exception as excp:
+                    node.fault(now, excp)
+                return
 
 class EnvironmentDht(EnironmentNode):
+    """The DHT transfers a measure in a single transaction, it is done in collect()."""
+    RETRIES = 9
+
     def __init__(self, pin):
+        #like the other drivers, only imported when the sensor is enabled
+        import dht
+        self.ERRORS = (OSError, dht.DHTChecksumError)
         super().__init__([self.get_temp_prop(), self.get_humid_prop()], None)
-        self.dht_retry = 0
-        self.dht_err_ctr = 0
+        #by default humidity changes are not reported, it is published every 10 minutes
+        self.properties[1].set_report(deadband=100, max_interval=600)
         self.driver = temp_sensor = dht.DHT22(pin, irq_block = False)
 
-    def periodic(self, now):
-        if (now % 60) == self.dht_retry :
-            try:
-                self.driver.measure()
-            except (OSError, dht.DHTChecksumError) as excp:
-                #If we have an exception, retry in 4 seconds
-                self.dht_retry +=4
-                self.dht_err_ctr += 1
-                if self.dht_retry == 40:
-                    #too many retries
-                    self.properties[0].alert()
-                    self.dht_retry = 70 # stop retrying
-                else:
-                    #logging
-                    print("DHT error, retrying")
-            else:
-                self.dht_retry = 0
-                self.dht_err_ctr = 0
-                #all went well let's publish temperature
-                self.properties[0].send_value(str(self.driver.temperature()))
-                print(self.driver.temperature())
-
-                #publish humidity
-                if (now % (60*10)) == self.dht_retry:
-                    self.properties[1].send_value(str(self.driver.humidity()))
+    def collect(self):
+        self.driver.measure()
+        #all went well let's publish temperature, values are sent in tenths
+        temp = round(self.driver.temperature()*10)
+        self.properties[0].report(temp)
+
+        #publish humidity
+        self.properties[1].report(round(self.driver.humidity()*10))
 
 class EnvironmentDS1820(EnironmentNode):
+    CONVERSION_MS = 750
+
     def __init__(self, driver, rom_id, num):
         super().__init__([self.get_temp_prop()], num)
         self.num = num
         self.driver = driver
         self.rom_id = rom_id
 
-    def periodic(self, now):
-        if (now % 60) == 0 and not self.num:
-            self.driver.convert_temp()
-        elif (now % 60) == 1:
-            temp = self.driver.read_temp(self.rom_id)
-            #all went well let's publish temperature
-            self.properties[0].send_value('{:.1f}'.format(temp))
-            print(temp)
+    def start(self):
+        self.driver.convert_temp()
+
+    def collect(self):
+        temp = round(self.driver.read_temp(self.rom_id)*10)
+        #all went well let's publish temperature, in tenths
+        self.properties[0].report(temp)
 
 class EnvironmentBME280(EnironmentNode):
+    """The driver starts the conversion and waits for it, it is done in collect()."""
+
     def __init__(self, i2c, addr, num):
         import bme280
         self.driver = bme280.BME280(address=addr, i2c=i2c)
@@ -75,15 +163,12 @@ class EnvironmentBME280(EnironmentNode):
         else:
             super().__init__([self.get_temp_prop(), self.get_press_prop()], num)
 
-    def periodic(self, now):
-        if (now % 60) == 0:
-            try:
-                temp,pa,hum = self.driver.read_compensated_data()
-            except OSError as excp:
-                self.properties[0].alert()
-            else:
-                self.properties[0].send_value('{:.1f}'.format(temp/100))
-                self.properties[1].send_value('{:.2f}'.format(pa/25600))
-                if self.driver.humidity_capable:
-                    self.properties[2].send_value(str(hum//1024))
-                print (temp/100,pa//25600,hum/1024)
+    def collect(self):
+        temp,pa,hum = self.driver.read_compensated_data()
+        #fixed point: 1/100 degC, Pa * 256 and %RH * 1024 to tenths of degC, 1/100 mBar and tenths of %RH
+        self.properties[0].report((temp + 5)//10)
+        self.properties[1].report((pa + 128)//256)
+        if self.driver.humidity_capable:
+            self.properties[2].report((hum*10 + 512)//1024)
+        if eventlog.level <= eventlog.DEBUG:
+            eventlog.debug("bme280 {} {} {}", temp, pa, hum)
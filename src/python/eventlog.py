@@ -0,0 +1,128 @@
+import sys
+import time
+import uio
+import uos
+from micropython import const
+
+#MicroPython counts time from 2000-01-01, records are stamped with Unix time
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+#records below level are dropped before being formatted, the ones from
+#flash_level up are also written on flash. A hot path tests the level
+#itself (if eventlog.level <= eventlog.DEBUG) so nothing is built for it.
+level = INFO
+flash_level = WARNING
+
+#last records kept in RAM
+RING_SIZE = const(32)
+#the flash log is written in batches of FLUSH_COUNT records, or the ones
+#waiting for FLUSH_MS, it is rotated to OLD_LOG_FILE once LOG_MAX bytes
+FLUSH_COUNT = const(8)
+FLUSH_MS = const(60000)
+LOG_FILE = "log.txt"
+OLD_LOG_FILE = "log.old"
+LOG_MAX = const(8192)
+#last crash, overwritten by the next one
+CRASH_FILE = "crash.txt"
+CRASH_MAX = const(2048)
+
+ring = [None] * RING_SIZE
+ring_pos = 0
+unsaved = []
+saved_at = time.ticks_ms()
+
+
+def log(lvl, fmt, *args):
+    """Records fmt.format(*args) with the Unix time and the level, prints it."""
+    global ring_pos
+    if lvl < level:
+        return
+    text = "{} {} {}".format(int(time.time()) + EPOCH_OFFSET, NAMES[lvl], fmt.format(*args) if args else fmt)
+    print(text)
+    ring[ring_pos] = text
+    ring_pos = (ring_pos + 1) % RING_SIZE
+    if lvl >= flash_level:
+        unsaved.append(text)
+        if len(unsaved) >= FLUSH_COUNT:
+            flush()
+
+
+def debug(fmt, *args):
+    log(DEBUG, fmt, *args)
+
+
+def info(fmt, *args):
+    log(INFO, fmt, *args)
+
+
+def warning(fmt, *args):
+    log(WARNING, fmt, *args)
+
+
+def error(fmt, *args):
+    log(ERROR, fmt, *args)
+
+
+def records():
+    """Records of the RAM ring, oldest first."""
+    return [text for text in ring[ring_pos:] + ring[:ring_pos] if text]
+
+
+def flush():
+    """Appends the unsaved records to the flash log, rotated when full."""
+    global saved_at
+    saved_at = time.ticks_ms()
+    if not unsaved:
+        return
+    try:
+        try:
+            if uos.stat(LOG_FILE)[6] >= LOG_MAX:
+                uos.rename(LOG_FILE, OLD_LOG_FILE)
+        except OSError:
+            #no log yet
+            pass
+        with open(LOG_FILE, "at") as log_file:
+            for text in unsaved:
+                log_file.write(text)
+                log_file.write("\n")
+    except OSError as excp:
+        print("log write error", excp)
+    del unsaved[:]
+
+
+def periodic():
+    """Writes the records waiting for more than FLUSH_MS."""
+    if unsaved and time.ticks_diff(time.ticks_ms(), saved_at) >= FLUSH_MS:
+        flush()
+
+
+def crash(excp):
+    """Logs the exception and stores its traceback as the last crash."""
+    trace = uio.StringIO()
+    sys.print_exception(excp, trace)
+    text = trace.getvalue()
+    sys.print_exception(excp)
+    log(ERROR, "crash {!r}", excp)
+    flush()
+    try:
+        with open(CRASH_FILE, "wt") as crash_file:
+            crash_file.write("{}\n".format(int(time.time()) + EPOCH_OFFSET))
+            crash_file.write(text[-CRASH_MAX:])
+    except OSError as excp:
+        print("crash write error", excp)
+
+
+def last_crash():
+    """Unix time and traceback of the last crash, None if there was none."""
+    try:
+        with open(CRASH_FILE, "rt") as crash_file:
+            return crash_file.read()
+    except OSError:
+        return None
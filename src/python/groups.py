@@ -0,0 +1,79 @@
+import time
+
+import homie
+import eventlog
+
+#pending timed commands, the later ones are dropped
+MAX_PENDING = 8
+#commands timed further away, or later than that, are refused (ticks_ms wrap around),
+#the less late ones run at once
+MAX_DELAY_MS = 600000
+
+
+def parse_time(stamp):
+    """Unix time in ms of the decimal seconds stamp, computed in ints as floats are too short."""
+    seconds, _, fraction = stamp.partition(b".")
+    return int(seconds)*1000 + int((fraction + b"000")[:3])
+
+
+class Groups:
+    """Runs the commands broadcast to the groups the device joined.
+
+    A command is published on homie/$broadcast/<group>/<node>/<property>
+    with the payload of a set command of the property, optionally followed
+    by "@" and the Unix time (decimals allowed) at which to run it. Timed
+    commands wait until then in a short list checked by run() every frame:
+    the devices of a group, their clocks set by NTP, all change in the same
+    frame. Without ntp_clock (or before it is set) they run at once.
+    Retained broadcasts are stale and ignored.
+    """
+
+    def __init__(self, names, ntp_clock):
+        self.prefixes = [(homie.HomieDevice.base + "/" + homie.HomieDevice.BROADCAST + "/" + name + "/").encode() for name in names]
+        self.clock = ntp_clock
+        self.device = None
+        #(ticks_ms, property path, payload) of the timed commands
+        self.pending = []
+
+    def on_broadcast(self, topic, content, retained):
+        if retained:
+            return
+        for prefix in self.prefixes:
+            if topic.startswith(prefix):
+                break
+        else:
+            return
+        path = topic[len(prefix):]
+        payload, _, stamp = content.partition(b"@")
+        delay = None
+        if stamp:
+            try:
+                unix_ms = parse_time(stamp)
+            except ValueError:
+                eventlog.warning("bad broadcast time {}", stamp)
+                return
+            if self.clock:
+                delay = self.clock.delay_to(unix_ms)
+        if delay is None:
+            self.execute(path, payload)
+        elif delay > MAX_DELAY_MS:
+            eventlog.warning("broadcast too far in the future {}", topic)
+        elif delay < -MAX_DELAY_MS:
+            eventlog.warning("stale broadcast {}", topic)
+        elif delay <= 0:
+            self.execute(path, payload)
+        elif len(self.pending) < MAX_PENDING:
+            self.pending.append((time.ticks_add(time.ticks_ms(), delay), path, payload))
+
+    def execute(self, path, payload):
+        if not self.device.set_property(path, payload):
+            eventlog.warning("no settable property {}", path)
+
+    def run(self):
+        if not self.pending:
+            return
+        now = time.ticks_ms()
+        for command in list(self.pending):
+            if time.ticks_diff(now, command[0]) >= 0:
+                self.pending.remove(command)
+                self.execute(command[1], command[2])
@@ -0,0 +1,130 @@
+import time
+import ustruct
+from array import array
+from micropython import const
+
+import eventlog
+
+#spill file record: time, property index, value
+RECORD = "<iBi"
+RECORD_SIZE = 9
+#evicted records are written on flash by batches of SPILL_BATCH
+SPILL_BATCH = const(16)
+
+
+class History:
+    """Bounded buffer of the measures taken while the broker is unreachable.
+
+    Records are (time, property index, fixed point value). The last size
+    ones are kept in RAM in arrays used as a ring. With spill records, a
+    record evicted from the full ring is written to a circular file of
+    spill records on flash instead of being dropped, by batches of
+    SPILL_BATCH records gathered in RAM to spare the flash. The oldest
+    records are always the first dropped, and the first returned by pop().
+
+    Records are stamped with the clock set by NTP: until synced is set the
+    measures are not kept, they would be stamped at the 2000 epoch.
+    """
+
+    def __init__(self, size, spill=0, path="history.bin"):
+        self.stamps = array("i", [0] * size)
+        self.values = array("i", [0] * size)
+        self.props = bytearray(size)
+        self.head = 0
+        self.count = 0
+        self.spill = spill
+        self.path = path
+        self.synced = False
+        self.file_head = 0
+        self.file_count = 0
+        self.record = bytearray(RECORD_SIZE)
+        #evicted records waiting to be written, from batch_head
+        self.batch = bytearray(min(SPILL_BATCH, spill) * RECORD_SIZE)
+        self.batch_head = 0
+        self.batch_count = 0
+        if spill:
+            #records of a previous run are not replayed, their properties may differ
+            with open(path, "wb"):
+                pass
+
+    def __len__(self):
+        return self.count + self.batch_count + self.file_count
+
+    def add(self, prop_idx, value):
+        if not self.synced:
+            return
+        size = len(self.stamps)
+        if self.count == size:
+            self.evict()
+        idx = (self.head + self.count) % size
+        self.stamps[idx] = int(time.time())
+        self.props[idx] = prop_idx
+        self.values[idx] = value
+        self.count += 1
+
+    def evict(self):
+        """Moves the oldest record of the ring to the spill batch, or drops it."""
+        head = self.head
+        self.head = (head + 1) % len(self.stamps)
+        self.count -= 1
+        if not self.spill:
+            return
+        end = self.batch_head + self.batch_count
+        if end * RECORD_SIZE == len(self.batch):
+            self.write_batch()
+            end = 0
+        ustruct.pack_into(RECORD, self.batch, end * RECORD_SIZE, self.stamps[head], self.props[head], self.values[head])
+        self.batch_count += 1
+
+    def write_batch(self):
+        """Appends the batched records to the spill file in one go, a full
+        file loses its oldest records."""
+        count = self.batch_count
+        start = (self.file_head + self.file_count) % self.spill
+        data = memoryview(self.batch)[self.batch_head * RECORD_SIZE:(self.batch_head + count) * RECORD_SIZE]
+        self.batch_head = self.batch_count = 0
+        #the records after the end of the file are written from its start
+        first = min(count, self.spill - start)
+        try:
+            with open(self.path, "r+b") as spill_file:
+                spill_file.seek(start * RECORD_SIZE)
+                spill_file.write(data[:first * RECORD_SIZE])
+                if first < count:
+                    spill_file.seek(0)
+                    spill_file.write(data[first * RECORD_SIZE:])
+        except OSError as excp:
+            eventlog.error("history spill error {}", excp)
+            return
+        total = self.file_count + count
+        if total > self.spill:
+            self.file_head = (self.file_head + total - self.spill) % self.spill
+            total = self.spill
+        self.file_count = total
+
+    def pop(self):
+        """Returns the oldest record as (time, property index, value), None when empty."""
+        if self.file_count:
+            try:
+                with open(self.path, "rb") as spill_file:
+                    spill_file.seek(self.file_head * RECORD_SIZE)
+                    spill_file.readinto(self.record)
+            except OSError as excp:
+                eventlog.error("history spill error {}", excp)
+                self.file_count = 0
+            else:
+                self.file_head = (self.file_head + 1) % self.spill
+                self.file_count -= 1
+                if not self.file_count:
+                    self.file_head = 0
+                return ustruct.unpack(RECORD, self.record)
+        if self.batch_count:
+            record = ustruct.unpack_from(RECORD, self.batch, self.batch_head * RECORD_SIZE)
+            self.batch_count -= 1
+            self.batch_head = self.batch_head + 1 if self.batch_count else 0
+            return record
+        if not self.count:
+            return None
+        head = self.head
+        self.head = (head + 1) % len(self.stamps)
+        self.count -= 1
+        return self.stamps[head], self.props[head], self.values[head]
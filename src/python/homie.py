@@ -1,90 +1,343 @@
 import time
+import uhashlib
 from micropython import const
 
+import mqtt_link
+import eventlog
+from eventlog import EPOCH_OFFSET
+
 VERSION = "3.0"
 
 KEEP_ALIVE = const(60)
-log = True
+#buffered measures published per main() call after a reconnection
+REPLAY_BATCH = const(4)
+
+#digest of the last complete advertisement, stored on flash
+ADVERT_FILE = "homie_adv.bin"
+
+
+def format_fixed(buf, value, decimals, pos=0):
+    """Writes the fixed point value (value / 10**decimals) in decimal in buf
+    from pos, returns the end position. Nothing is allocated for small ints."""
+    if value < 0:
+        buf[pos] = 45 #-
+        pos += 1
+        value = -value
+    digits = 1
+    scan = value
+    while scan >= 10:
+        scan //= 10
+        digits += 1
+    if digits <= decimals:
+        digits = decimals + 1
+    end = pos + digits + (1 if decimals else 0)
+    idx = end
+    for count in range(digits):
+        if decimals and count == decimals:
+            idx -= 1
+            buf[idx] = 46 #.
+        idx -= 1
+        buf[idx] = 48 + value % 10
+        value //= 10
+    return end
 
 
 class HomieDevice:
+    """Homie device on the umqtt client, nothing blocks the loop.
+
+    The device is created offline, main() connects it (mqtt_link.Connector)
+    then publishes the advertisement one element (the device, each property)
+    at a time while the in-flight window has room. Once the advertisement is
+    acknowledged the device is started and $state is ready. A connection
+    lost meanwhile pauses the advertisement, it goes on once reconnected.
+    """
     base = "homie"
     BROADCAST = "$broadcast"
 
-    def __init__(self, mqtt, device_id, nodes, nice_device_name, broadcast_cb=None):
+    def __init__(self, mqtt, device_id, nodes, nice_device_name, broadcast_cb=None, inflight=0, force_advert=False, history=None,
+                 offline_queue=0):
         self.mqtt = mqtt
         self.nodes = nodes
         self.nice_device_name = nice_device_name
         self.user_cb = None
         self.broadcast_cb = broadcast_cb
         self.mqtt.set_callback(self.subscribe_cb)
-        self.publish_wait_queue = []
-
-        base_list = [self.base, device_id.decode("ascii"), "$state" ]
-        self.state_topic = "/".join(base_list)
+        # property -> latest value waiting to be published, see Property.send_value
+        self.pending_values = {}
+        # set topic (bytes) -> (property, topic_split), filled by Property.expose
+        self.set_routes = {}
+        self.broadcast_prefix = "/".join([self.base, self.BROADCAST, ""]).encode()
+        #exposed properties, a property index identifies it in the history
+        self.props = []
+        #measures taken while offline, replayed once reconnected (history.History)
+        self.history = history
+
+        self.base_list = [self.base, device_id.decode("ascii")]
+        self.state_topic = "/".join(self.base_list + ["$state"])
+        self.stats_topic = "/".join(self.base_list + ["$stats", ""])
+        self.device_prefix = "/".join(self.base_list + [""]).encode()
         self.mqtt.set_last_will(self.state_topic, "lost", True, 1)
 
-        self.mqtt.connect(clean_session=True)
-        self.mqtt.disconnect()
-        self.mqtt.connect(clean_session=False)
-
-        base_list[-1] = "$homie"
-        self.publish(base_list, VERSION)
-
-        base_list[-1] = "$name"
-        self.name_topic = self.publish(base_list, nice_device_name)
-
-        self.publish(self.state_topic, "init")
-
-        base_list[-1] = "$nodes"
-        self.publish(base_list, ",".join([node.node_id for node in self.nodes]))
-
-        settable = False
-        for node in nodes:
-            settable |= node.expose(self, list(base_list))
-        if settable:
-            base_list[-1] = "+"
-            base_list.append("+")
-            base_list.append("set")
-            mqtt.subscribe("/".join(base_list), 1)
+        #connected by main(), the first connection starts the advertisement
+        self.online = False
+        self.was_online = False
+        self.link = mqtt_link.Connector(mqtt)
+        self.state = "init"
+        self.last_state_epoc = time.time()
+        #set once the advertisement is acknowledged
+        self.started = False
+        #topics subscribed, subscribed again if the broker lost the session (the
+        #ones not acknowledged before a connection loss are always subscribed again)
+        self.subscriptions = []
+        #topic -> (value, qos, retained) of the last publications made while
+        #offline, up to offline_queue topics, published once reconnected
+        self.offline_queue = offline_queue
+        self.queued = {}
+        self.publish_count = 0
+        self.reconnects = 0
+        #numeric values are formatted and sent from these buffers, see publish_payload
+        self.payload = bytearray(24)
+        self.header = bytearray(7)
+
+        #qos 1 publications are pipelined in an in-flight window, with inflight
+        #0 a window of one: each publication waits for the previous acknowledge
+        self.window = mqtt_link.PublishWindow(mqtt, max(inflight, 1))
+
+        #retained attributes are only published when they differ from the last advertisement
+        self.advert_digest = self.digest()
+        self.full_advert = force_advert or self.advert_digest != self.stored_digest()
+        self.advert = self.advertise()
+
+    def advertise(self):
+        """Generator publishing the advertisement, it stops after the device
+        attributes and after each property, see advance()."""
+        self.publish_attributes(list(self.base_list), self.attributes())
+        yield
+        for node in self.nodes:
+            for _ in node.expose(self, self.base_list + [None]):
+                yield
+        if self.set_routes:
+            self.subscribe("/".join(self.base_list + ["+", "+", "set"]))
+        if self.broadcast_cb:
+            self.subscribe(self.broadcast_prefix + b"#")
+
+    def advance(self):
+        """Goes on with the advertisement while the window has room, starts the
+        device once every publication of the advertisement is acknowledged."""
+        while self.advert and self.online and not self.queued and self.window.free():
+            try:
+                next(self.advert)
+            except StopIteration:
+                self.advert = None
+        if self.advert or not self.online or self.queued or self.window.inflight:
+            return
+        if self.full_advert:
+            self.store_digest(self.advert_digest)
+        self.started = True
+        self.ready()
 
-        time.sleep(1)
-        while(mqtt.check_msg()):
+    def subscribe(self, topic):
+        """The SUBACK is read by check_msg(), the topic is subscribed again
+        when it was not acknowledged or the broker lost the session."""
+        self.subscriptions.append(topic)
+        try:
+            self.window.subscribe(topic)
+        except OSError as excp:
+            self.connection_lost(excp)
+
+    def attributes(self):
+        yield "$homie", VERSION
+        yield "$name", self.nice_device_name
+        yield "$nodes", ",".join([node.meta[0] for node in self.nodes])
+
+    def publish_attributes(self, base_list, attributes):
+        if self.full_advert:
+            base_list.append(None)
+            for attr, value in attributes:
+                base_list[-1] = attr
+                self.publish(base_list, value)
+
+    def digest(self):
+        """Hash of every retained attribute the device advertises (broker included)."""
+        digest = uhashlib.sha256(self.state_topic.encode())
+        digest.update(self.mqtt.server.encode())
+        self.hash_attributes(digest, "", self)
+        for node in self.nodes:
+            self.hash_attributes(digest, node.meta[0], node)
+            for prop in node.properties:
+                self.hash_attributes(digest, prop.meta[0], prop)
+        return digest.digest()
+
+    @staticmethod
+    def hash_attributes(digest, elem_id, elem):
+        digest.update(elem_id.encode())
+        for attr, value in elem.attributes():
+            digest.update(attr.encode())
+            digest.update(value if isinstance(value, bytes) else value.encode())
+
+    @staticmethod
+    def stored_digest():
+        try:
+            with open(ADVERT_FILE, "rb") as adv_file:
+                return adv_file.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def store_digest(digest):
+        try:
+            with open(ADVERT_FILE, "wb") as adv_file:
+                adv_file.write(digest)
+        except OSError:
             pass
 
-        if broadcast_cb:
-            mqtt.subscribe("/".join([self.base, self.BROADCAST, '#']), 1)
-
-        self.ready()
-
     def set_user_cb(self, cb):
         self.user_cb = cb
 
     def subscribe_cb(self, topic, content, retain):
-        topic_split = topic.decode("ascii").split("/")
-        value = content.decode("utf-8")
-        found = False
-        if len(topic_split) == 5 and topic_split[4] == "set":
-            for node in self.nodes:
-                found = node.action_set(topic_split, value)
-                if found:
-                    break;
-        if not found and self.broadcast_cb and topic_split[1]=="$broadcast":
-            self.broadcast_cb(topic, content, retain)
-            found = True
-        if not found and self.user_cb:
-            self.user_cb(topic, content)
+        """A malformed payload (ValueError, or ArithmeticError for inf and nan)
+        is logged and dropped without echo, the message is still acknowledged
+        and the next ones handled."""
+        try:
+            route = self.set_routes.get(topic)
+            if route:
+                prop, topic_split = route
+                prop.on_set(topic_split, content.decode("utf-8"))
+            elif self.broadcast_cb and topic.startswith(self.broadcast_prefix):
+                self.broadcast_cb(topic, content, retain)
+            elif self.user_cb:
+                self.user_cb(topic, content)
+        except (ValueError, ArithmeticError) as excp:
+            eventlog.warning("dropped {} {}: {!r}", topic, content, excp)
+
+    def set_property(self, path, content):
+        """Runs the set command of the property at path (b"node/property") as if
+        received on its set topic, returns False when there is no such settable
+        property or the content is malformed."""
+        route = self.set_routes.get(self.device_prefix + path + b"/set")
+        if not route:
+            return False
+        prop, topic_split = route
+        try:
+            prop.on_set(topic_split, content.decode("utf-8"))
+        except (ValueError, ArithmeticError) as excp:
+            eventlog.warning("dropped {} {}: {!r}", path, content, excp)
+            return False
+        return True
 
     def publish(self, topic, value, qos=1, retained=True):
+        """Never blocks: publications made while offline are queued (see
+        offline_queue) or dropped, QoS 1 ones finding the window full are
+        queued and published by main() once it has room. QoS 1 ones already
+        in the window are sent again once reconnected."""
         if isinstance(topic, list):
             joint_topic = "/".join(topic)
         else:
             joint_topic = topic
-        if log:
-            print(joint_topic, value)
-        self.mqtt.publish(joint_topic, value, retained, qos)
+        if eventlog.level <= eventlog.DEBUG:
+            eventlog.debug("{} {}", joint_topic, value)
+        if not self.online:
+            self.queue(joint_topic, value, qos, retained)
+            return joint_topic
+        self.publish_count += 1
+        try:
+            if qos == 1:
+                if not self.window.publish(joint_topic, value, retained):
+                    #a few topics only ($state, $stats, the current advertisement element),
+                    #not bounded by offline_queue
+                    self.queued[joint_topic] = (value, qos, retained)
+            else:
+                mqtt_link.write_publish(self.mqtt.sock, self.header, joint_topic, value, len(value), retained)
+        except OSError as excp:
+            self.connection_lost(excp)
         return joint_topic
 
+    def publish_payload(self, topic, size, retained):
+        """QoS 0 publication of the size first bytes of self.payload on topic (bytes),
+        written straight on the socket so nothing is allocated."""
+        if eventlog.level <= eventlog.DEBUG:
+            eventlog.debug("{} {}", topic, bytes(self.payload[:size]))
+        if not self.online:
+            self.queue(topic, bytes(self.payload[:size]), 0, retained)
+            return
+        self.publish_count += 1
+        try:
+            mqtt_link.write_publish(self.mqtt.sock, self.header, topic, self.payload, size, retained)
+        except OSError as excp:
+            self.connection_lost(excp)
+
+    def check_msg(self):
+        if not self.online:
+            return False
+        try:
+            return self.window.poll()
+        except OSError as excp:
+            self.connection_lost(excp)
+            return False
+
+    def queue(self, topic, value, qos, retained):
+        #the advertisement waits for the connection, what its element still publishes is kept
+        if not self.started or topic in self.queued or len(self.queued) < self.offline_queue:
+            self.queued[topic] = (value, qos, retained)
+
+    def connection_lost(self, excp):
+        eventlog.warning("MQTT connection lost {}", excp)
+        self.online = False
+        self.link.lost()
+
+    def reconnected(self, session_present):
+        """Restores what the device had before the connection was lost: the
+        subscriptions (all of them when the broker did not keep the session,
+        the ones not acknowledged otherwise), the publications still in the
+        window, $state (the broker published the last will) and the
+        publications queued meanwhile."""
+        self.online = True
+        if self.was_online:
+            self.reconnects += 1
+        self.was_online = True
+        window = self.window
+        try:
+            #subscribing again to every topic would have retained set commands delivered again
+            topics = list(window.subscribing.values()) if session_present else self.subscriptions
+            window.subscribing.clear()
+            for topic in topics:
+                window.subscribe(topic)
+            window.resend()
+        except OSError as excp:
+            self.connection_lost(excp)
+            return
+        self.queued.pop(self.state_topic, None)
+        self.publish_state()
+        self.publish_queued()
+
+    def publish_queued(self):
+        """Publishes the queued publications while the window has room."""
+        while self.queued and self.online and self.window.free():
+            topic = next(iter(self.queued))
+            value, qos, retained = self.queued.pop(topic)
+            self.publish(topic, value, qos, retained)
+
+    def replay(self):
+        """Publishes a few buffered measures on the $history topic of their
+        property as "time,value", through the window and only while it is
+        less than half full, so live publications are not delayed."""
+        history = self.history
+        window = self.window
+        payload = self.payload
+        for _ in range(REPLAY_BATCH):
+            if not len(history) or window.free() <= window.size >> 1 or not self.online:
+                return
+            stamp, prop_idx, value = history.pop()
+            prop = self.props[prop_idx]
+            size = format_fixed(payload, stamp + EPOCH_OFFSET, 0)
+            payload[size] = 44 #,
+            size = format_fixed(payload, value, prop.decimals, size + 1)
+            self.publish(prop.value_topic + b"/$history", bytes(payload[:size]), 1, False)
+
+    def publish_stat(self, name, value):
+        """Publishes the $stats/name attribute of the device."""
+        self.publish(self.stats_topic + name, value)
+
     def alert(self):
         self.state = "alert"
         self.publish_state()
@@ -98,80 +351,91 @@ class HomieDevice:
         self.last_state_epoc = time.time()
 
     def main(self):
-        self.mqtt.check_msg()
-        while len(self.publish_wait_queue):
-            prop, value = self.publish_wait_queue.pop()
-            prop.send_value(value)
+        if not self.online:
+            session_present = self.link.step()
+            if session_present is not None:
+                self.reconnected(session_present)
+        else:
+            self.check_msg()
+            if self.queued:
+                self.publish_queued()
+            if not self.started:
+                self.advance()
+            elif self.history:
+                self.replay()
+        if self.pending_values:
+            now = time.ticks_ms()
+            for prop in list(self.pending_values):
+                if prop.may_send(now):
+                    prop.publish_value(self.pending_values.pop(prop))
         now = time.time()
         if now - self.last_state_epoc > KEEP_ALIVE:
             self.publish_state()
 
 
 class Node:
+    """Nodes and properties keep their advertisement data in a single meta
+    tuple, released once exposed: the device only needs the topics afterward.
+    """
+
     def __init__(self, node_id, name, properties):
-        self.node_id = node_id
-        self.name = name
+        self.meta = (node_id, name)
         self.properties = properties
 
-    def expose(self, homie, base_list):
-        base_list[-1] = self.node_id
-
-        base_list.append("$name")
-        homie.publish(base_list, self.name)
+    def attributes(self):
+        yield "$name", self.meta[1]
+        yield "$properties", ",".join([prop.meta[0] for prop in self.properties])
 
-        base_list[-1] = "$properties"
-        homie.publish(base_list, ",".join([prop.property_id for prop in self.properties]))
+    def expose(self, homie, base_list):
+        """Generator publishing the node then its properties, it stops after each property."""
+        base_list[-1] = self.meta[0]
+        homie.publish_attributes(list(base_list), self.attributes())
+        self.meta = None
 
-        settable = False
+        base_list.append(None)
         for prop in self.properties:
-            settable |= prop.expose(homie, list(base_list))
-        return settable
-
-    def action_set(self, topic_split, value):
-        if topic_split[2] == self.node_id:
-            for prop in self.properties:
-                if prop.check_msg(topic_split, value):
-                    return True
-        return False
+            prop.expose(homie, list(base_list))
+            yield
 
 class Property:
-    def __init__(self, property_id, name, type, unit, format, init_value, value_set_cb=None, retained=True):
-        self.property_id = property_id
-        self.name = name
-        self.type = type
-        self.unit = unit
-        self.format = format
-        self.init_value = str(init_value)
+    def __init__(self, property_id, name, type, unit, format, init_value, value_set_cb=None, retained=True, min_interval=0, decimals=0):
+        self.meta = (property_id, name, type, unit, format, init_value)
         self.retained = retained
         self.value_set_cb = value_set_cb
+        self.min_interval = min_interval
+        #ints given to send_value are fixed point values with this many decimals
+        self.decimals = decimals
+        #(deadband, relative %, max interval ms) used by report(), see set_report
+        self.policy = None
+
+    def attributes(self):
+        meta = self.meta
+        yield "$name", meta[1]
+        yield "$datatype", meta[2]
+        if meta[3]:
+            yield "$unit", meta[3]
+        if meta[4]:
+            yield "$format", meta[4]
+        if not self.retained:
+            yield "$retained", "false"
+        if self.value_set_cb:
+            yield "$settable", "true"
 
     def expose(self, homie, base_list):
         self.homie = homie
 
-        base_list[-1] = self.property_id
-        self.value_topic = self.homie.publish(base_list, self.init_value)
-
-        base_list.append("$name")
-        self.homie.publish(base_list, self.name)
+        base_list[-1] = self.meta[0]
+        self.index = len(homie.props)
+        homie.props.append(self)
+        self.value_topic = self.homie.publish(base_list, str(self.meta[5])).encode()
+        self.last_sent = time.ticks_ms()
 
-        base_list[-1] = "$datatype"
-        self.homie.publish(base_list, self.type)
-
-        if self.unit:
-            base_list[-1] = "$unit"
-            self.homie.publish(base_list, self.unit)
-
-        if self.format:
-            base_list[-1] = "$format"
-            self.homie.publish(base_list, self.format)
-
-        if not self.retained:
-            base_list[-1] = "$retained"
-            self.homie.publish(base_list, "false")
+        self.homie.publish_attributes(list(base_list), self.attributes())
+        self.meta = None
 
         if self.value_set_cb:
-            base_list[-1] = "$settable"
-            self.homie.publish(base_list, "true")
+            base_list.append("set")
+            self.homie.set_routes[self.value_topic + b"/set"] = (self, base_list)
             return True
         return False
 
@@ -179,15 +443,66 @@ class Property:
         self.homie.alert()
 
     def send_value(self, value, deferred=False):
-        if deferred:
-            self.homie.publish_wait_queue.append((self, value))
+        """Publishes value, or keeps it as the pending value of the property when
+        deferred or when the last publication is less than min_interval ms old.
+
+        Pending values are published by HomieDevice.main, a newer value replaces
+        the pending one so only the last value of a burst is published.
+
+        An int value is a fixed point number with self.decimals decimals (215 is
+        published as 21.5 with one decimal), its publication allocates nothing.
+        """
+        if self.meta:
+            #not exposed yet (staged boot), advertised as the initial value
+            self.meta = self.meta[:5] + (value,)
+        elif deferred or not self.may_send(time.ticks_ms()):
+            self.homie.pending_values[self] = value
+        else:
+            self.publish_value(value)
+
+    def set_report(self, deadband=0, relative=0, min_interval=0, max_interval=0):
+        """Reporting policy of report(): a value is sent when it differs from the
+        last reported one by at least deadband (in the published unit) and
+        relative percent of it, or when the last report is max_interval seconds
+        old. Reports are at least min_interval seconds apart (the last value
+        of a burst is kept, see send_value)."""
+        self.policy = (round(deadband * 10**self.decimals), relative, max_interval*1000)
+        self.min_interval = min_interval*1000
+        self.reported = None
+        self.reported_at = 0
+
+    def report(self, value):
+        """send_value for measures (fixed point ints), filtered by the reporting policy."""
+        policy = self.policy
+        if policy:
+            now = time.ticks_ms()
+            last = self.reported
+            if last is not None and not (policy[2] and time.ticks_diff(now, self.reported_at) >= policy[2]):
+                if abs(value - last) < max(policy[0], abs(last)*policy[1]//100):
+                    return
+            self.reported = value
+            self.reported_at = now
+        self.send_value(value)
+
+    def may_send(self, now):
+        return time.ticks_diff(now, self.last_sent) >= self.min_interval
+
+    def publish_value(self, value):
+        """Publishes value, while offline measures (ints of properties which
+        are not settable) go to the device history."""
+        homie = self.homie
+        homie.pending_values.pop(self, None)
+        self.last_sent = time.ticks_ms()
+        if not homie.online and isinstance(value, int) and not self.value_set_cb:
+            if homie.history is not None:
+                homie.history.add(self.index, value)
+        elif isinstance(value, int):
+            homie.publish_payload(self.value_topic, format_fixed(homie.payload, value, self.decimals), self.retained)
         else:
             self.homie.publish(self.value_topic, value, 0, self.retained)
 
-    def check_msg(self, topic_split, value):
-        if topic_split[3] == self.property_id and self.value_set_cb:
-            if self.value_set_cb(topic_split, value):
-                self.send_value(value, True)
-            return True
-        else:
-            return False
+    def on_set(self, topic_split, value):
+        """The callback returns True to echo value, or the string to echo instead."""
+        echo = self.value_set_cb(topic_split, value)
+        if echo:
+            self.send_value(value if echo is True else echo, True)
@@ -1,21 +1,30 @@
+import time
+#boot phases are timed from here, the imports and the gamma table included
+BOOT_TICKS = time.ticks_ms()
+
 import robust
-from machine import Pin, PWM, ADC, I2C, RTC, reset
+from machine import Pin, PWM, ADC, I2C, reset
 import ubinascii
-import time
 import ujson
 import sys
 import network
-import math
-
-import ntptime
+from micropython import const
+from array import array
 
 import homie
-import env_sensors
+import buttons
+import effects
+import transition
+import scheduler
+import eventlog
+import snapshot
+#env_sensors, stats, history, clock and groups are imported when the config enables them
 
 config = {
 "esp32" : False,
 "client_id" : b"esp_" + ubinascii.hexlify(network.WLAN().config('mac')),
 "broker" : "192.168.2.25",
+"ntp_host" : "fr.pool.ntp.org",
 "location" : "",
 "dht" : False,
 "ds1820" : False,
@@ -26,100 +35,244 @@ config = {
 "analog2_period" : 0,
 "analog2_bits" : 10,
 "analog2_attn": 0,
+"analog_sample_ms" : 20,
+"analog_window" : 16,
+"sensor_period" : 60,
+"report" : {},
+"mqtt_inflight" : 8,
+"force_advert" : False,
+"publish_interval" : 250,
+"fade_ms" : 200,
+"stats_period" : 0,
+"history_size" : 64,
+"history_spill" : 0,
+"offline_queue" : 16,
+"snapshot_flash_s" : 60,
+"watchdog_s" : 60,
+"groups" : [],
+"log_level" : "info",
+"flash_log_level" : "warning",
 "debug" : False
 }
 
+#periods of the scheduled tasks in ms
+MQTT_PERIOD = const(50)
+SENSORS_PERIOD = const(200)
+CLOCK_PERIOD = const(100)
+LOG_PERIOD = const(1000)
+SNAPSHOT_PERIOD = const(500)
+
+#scheduled jobs, names used by the loop statistics
+STAGES = ("mqtt", "cycler", "fader", "sensors", "adc", "sampling", "buttons", "stats", "clock", "groups", "log", "snapshot", "watchdog")
+
+def fade_time(values, count):
+    """Fade duration in ms given after the count values of a set command, or the default one."""
+    if len(values) > count:
+        return int(values[count])
+    return config["fade_ms"]
+
 class ColorManager:
-    def __init__(self, dimmers):
-        self.props = [ homie.Property("color", "desired color RGB", "color", None, "rgb", "000,000,000", self.set_color),
-                        homie.Property("cycler", "cycler mode", "integer", None, None, "0", self.set_cycler) ]
+    PERIOD = effects.FRAME_MS
+
+    def __init__(self, dimmers, fader):
+        self.fader = fader
+        self.props = [ homie.Property("color", "desired color RGB", "color", None, "rgb", "000,000,000", self.set_color,
+                                      min_interval=config["publish_interval"]),
+                        homie.Property("cycler", "cycler mode", "integer", None, "0:29", "0", self.set_cycler) ]
         self.dimmers = dimmers[:3]
         self.cycle = 0
-        self.angles = [math.pi,math.pi,math.pi]
-        self.increments = [math.pi/180, math.pi/270, math.pi/225]
+        self.effects = effects.Effects([dimmer.pwm for dimmer in self.dimmers])
         for dimmer in self.dimmers:
             dimmer.cycler = self
 
     def set_color(self, topic, value):
-        for dimmer, val in zip(self.dimmers, value.split(",")):
-            dimmer.pwm.duty(int(float(val)*1023/255))
+        """r,g,b (0-255) optionally followed by the fade duration in ms"""
+        values = value.split(",")
+        #parsed before anything changes, a malformed color is dropped as a whole
+        levels = [int(float(val)*257) for val in values[:3]]
+        duration = fade_time(values, 3)
         self.stop_cycling()
-        return True
+        for dimmer, level in zip(self.dimmers, levels):
+            self.fader.fade(dimmer.channel, level, duration)
+        return ",".join(values[:3])
+
+    def color(self):
+        """Color value (r,g,b) of the channel targets."""
+        return ",".join(["{:03}".format(dimmer.channel.target*255//transition.LEVEL_MAX) for dimmer in self.dimmers])
 
     def do_cycle(self):
         if self.cycle:
-            for angle, dimmer in zip(self.angles, self.dimmers):
-                dimmer.pwm.duty(int(511*math.cos(angle)+511))
-            self.angles = [ (angle + inc*self.cycle)%(math.pi*2) for angle, inc in zip(self.angles, self.increments) ]
+            self.effects.frame()
 
     def stop_cycling(self):
         if self.cycle:
-            self.cycle = 0
+            self.set_cycler(None, 0)
             self.props[1].send_value(str(0))
 
     def set_cycler(self, topic, value):
-        self.cycle = int(value)
+        """0 stops, 1-9 cycles, 11-19 rainbow, 21-29 breathes the current color, units are the speed."""
+        value = int(value)
+        if value and not self.effects.select(value):
+            return False
+        if self.cycle and not value:
+            for dimmer in self.dimmers:
+                dimmer.channel.sync()
+        self.cycle = value
         return True
 
 
-class Dimmer(homie.Property):
+class SceneManager:
+    """Sets all the dimmer channels from a single message.
+
+    The fades of a scene start together so the fader moves every channel in
+    the same frames. The new dimmer (and color) values are echoed as pending
+    values, published together by the next HomieDevice.main call. Stored
+    scenes are kept in SCENES_FILE, by id, as the channel levels.
+    """
+    SCENES_FILE = "scenes.json"
+
+    def __init__(self, dimmers, color_manager, fader):
+        self.dimmers = dimmers
+        self.color_manager = color_manager
+        self.fader = fader
+        self.props = [ homie.Property("levels", "levels of every channel", "string", None, None, "", self.set_levels),
+                       homie.Property("recall", "stored scene applied", "integer", None, None, "0", self.recall),
+                       homie.Property("store", "scene storing the current levels", "integer", None, None, "0", self.store, retained=False) ]
+
+    def set_levels(self, topic, value):
+        """one percentage per channel (an empty one keeps the channel) optionally followed by the fade duration in ms"""
+        values = value.split(",")
+        count = len(self.dimmers)
+        self.apply([int(float(val)*transition.LEVEL_MAX/100) if val else None for val in values[:count]], fade_time(values, count))
+        #the levels without the fade duration, like the dimmers echo
+        return ",".join(values[:count])
+
+    def recall(self, topic, value):
+        """scene id optionally followed by the fade duration in ms"""
+        values = value.split(",")
+        levels = self.load().get(values[0])
+        if levels is None:
+            eventlog.warning("unknown scene {}", values[0])
+            return False
+        self.apply(levels, fade_time(values, 1))
+        return values[0]
+
+    def store(self, topic, value):
+        scenes = self.load()
+        scenes[str(int(value))] = [dimmer.channel.target for dimmer in self.dimmers]
+        try:
+            with open(self.SCENES_FILE, "wt") as scenes_file:
+                scenes_file.write(ujson.dumps(scenes))
+        except OSError as excp:
+            eventlog.error("scene store error {}", excp)
+            return False
+        return True
+
+    def load(self):
+        try:
+            with open(self.SCENES_FILE, "rt") as scenes_file:
+                return ujson.loads(scenes_file.read())
+        except (OSError, ValueError):
+            return {}
+
+    def apply(self, levels, duration):
+        color_manager = self.color_manager
+        changed = [dimmer for dimmer, level in zip(self.dimmers, levels) if level is not None]
+        color_changed = any(dimmer in color_manager.dimmers for dimmer in changed)
+        if color_changed:
+            color_manager.stop_cycling()
+        for dimmer, level in zip(self.dimmers, levels):
+            if level is not None:
+                self.fader.fade(dimmer.channel, level, duration)
+        for dimmer in changed:
+            dimmer.send_value(dimmer.percent(), True)
+        if color_changed:
+            color_manager.props[0].send_value(color_manager.color(), True)
 
-    def __init__(self, dim_id, pwm, bt_pin):
-        super(Dimmer, self).__init__("chan-"+dim_id.lower(), "Dimmer "+dim_id.upper(), "float", "%", "0:100", 0, self.set_value)
+
+class Dimmer(homie.Property):
+    PERIOD = const(50)
+    RAMP_MS = const(100)
+    RAMP_STEP = const(1600)
+    TOP_PAUSE_MS = const(750)
+
+    def __init__(self, dim_id, pwm, bt_pin, fader):
+        super(Dimmer, self).__init__("chan-"+dim_id.lower(), "Dimmer "+dim_id.upper(), "float", "%", "0:100", 0, self.set_value,
+                                     min_interval=config["publish_interval"])
         self.pwm = pwm
-        self.button = Pin(bt_pin, Pin.IN, Pin.PULL_UP)
-        self.time_cnt = 0
-        self.last_value = 1023
-        self.delta = 25
-        self.top_pause = 0
+        self.fader = fader
+        self.channel = fader.channel(pwm)
+        self.button = buttons.Button(bt_pin)
+        self.last_value = transition.LEVEL_MAX
+        self.delta = self.RAMP_STEP
+        self.next_step = 0
+        self.stop_cycler = False
         self.cycler = None
 
     def periodic(self):
-        """Short press (less than 10 calls) switches on and off, long press (more than 10 calls)
-        increases brightness (every 2 calls) and when at maximum decrease brightness to zero while button is pressed.
+        """Short press switches on and off, long press (more than buttons.LONG_PRESS_MS) increases brightness
+        (every RAMP_MS) and when at maximum decrease brightness to zero while button is pressed.
 
         Buttons are active low, hardware uses internall ESP pull up for open position.
+        A press while the cycler runs only stops the cycler.
         """
-        if self.button.value() == 0:
-            if self.time_cnt > 10 and self.time_cnt % 2 == 0 and self.top_pause == 0:
-                self.time_cnt += 1
-                self.pwm.duty( self.pwm.duty() + self.delta )
-                if self.pwm.duty() == 0:
+        event = self.button.poll()
+        while event:
+            if event == buttons.PRESS:
+                self.stop_cycler = self.cycler and self.cycler.cycle
+            elif event == buttons.LONG_PRESS:
+                self.next_step = time.ticks_ms()
+            elif self.stop_cycler:
+                self.cycler.stop_cycling()
+            elif not self.button.long:
+                if self.channel.target == 0:
+                    self.fader.fade(self.channel, self.last_value, config["fade_ms"])
+                else:
+                    self.last_value = self.channel.target
+                    self.fader.fade(self.channel, 0, config["fade_ms"])
+                self.send_value(self.percent())
+            event = self.button.poll()
+
+        if self.button.pressed and self.button.long and not self.stop_cycler:
+            now = time.ticks_ms()
+            if time.ticks_diff(now, self.next_step) >= 0:
+                self.next_step = time.ticks_add(now, self.RAMP_MS)
+                level = min(max(self.channel.target + self.delta, 0), transition.LEVEL_MAX)
+                self.fader.fade(self.channel, level, self.RAMP_MS)
+                if level == 0:
                     self.delta = -self.delta
-                elif self.pwm.duty() == 1023:
+                elif level == transition.LEVEL_MAX:
                     self.delta = -self.delta
-                    self.top_pause = 15
-                print(self.pwm.duty(), self.delta)
-                self.send_value(str(int(self.pwm.duty()/1023*100)))
-            else:
-                self.time_cnt += 1
-                if self.cycler and self.cycler.cycle:
-                    self.time_cnt = -1
-                if self.top_pause:
-                    self.top_pause -= 1
-        elif 0 < self.time_cnt <= 10:
-            self.top_pause = 0
-            if self.pwm.duty() == 0:
-                self.pwm.duty(self.last_value)
-            else:
-                self.last_value = self.pwm.duty()
-                self.pwm.duty(0)
-            self.send_value(str(int(self.pwm.duty()/1023*100)))
-            self.time_cnt = 0
-        elif self.time_cnt == -1:
-            self.cycler.stop_cycling()
-            self.time_cnt = 0
-        else:
-            self.time_cnt = 0
+                    self.next_step = time.ticks_add(now, self.TOP_PAUSE_MS)
+                if eventlog.level <= eventlog.DEBUG:
+                    eventlog.debug("ramp {} {}", level, self.delta)
+                self.send_value(self.percent())
+
+    def percent(self):
+        #rounded, a level set in percent is echoed unchanged
+        return (self.channel.target*100 + transition.LEVEL_MAX//2)//transition.LEVEL_MAX
 
     def set_value(self, topic, value):
-        self.pwm.duty(int(float(value)/100*1023))
-        return True
+        """percentage optionally followed by the fade duration in ms"""
+        values = value.split(",")
+        self.fader.fade(self.channel, int(float(values[0])*transition.LEVEL_MAX/100), fade_time(values, 1))
+        return values[0]
 
 class Analog(homie.Property):
+    """Analog input sampled by AnalogSampler between publications.
+
+    Every analog period the mean of the samples taken since the last
+    publication is published as the value of the property, the minimum,
+    maximum and the median of the last window samples as the -min, -max and
+    -median properties (props holds the four of them). Without samples the
+    input is read once. Values are in volts, 3 decimals.
+    """
     maxes=[1,1.34,2,3.6]
-    def __init__(self, prop_id, prop_name, pin, period, bits=10, attn=0):
-        super(Analog, self).__init__(prop_id, prop_name, "float", None, "0:{}".format(Analog.maxes[attn]), 0)
+    def __init__(self, prop_id, prop_name, pin, period, bits=10, attn=0, window=16):
+        value_format = "0:{}".format(Analog.maxes[attn])
+        super(Analog, self).__init__(prop_id, prop_name, "float", None, value_format, 0, decimals=3)
+        self.props = [self] + [homie.Property("{}-{}".format(prop_id, agg), "{} {}".format(prop_name, agg), "float", None, value_format, 0, decimals=3)
+                               for agg in ("min", "max", "median")]
         if config["esp32"]:
             pin = Pin(pin)
         self.adc = ADC(pin)
@@ -128,32 +281,160 @@ class Analog(homie.Property):
             self.adc.width(bits-9)
         self.period = period
         self.range = (2**bits)-1
-        self.max = Analog.maxes[attn]
+        #full scale in mV, values are published in mV with 3 decimals
+        self.max = int(Analog.maxes[attn]*1000)
+        #ring of the last samples for the median, and a copy sorted when publishing
+        self.ring = array("H", [0] * window)
+        self.ordered = array("H", [0] * window)
+        self.ring_pos = 0
+        self.ring_len = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.low = self.range
+        self.high = 0
+
+    def sample(self):
+        value = self.adc.read()
+        self.count += 1
+        self.total += value
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+        self.ring[self.ring_pos] = value
+        self.ring_pos = (self.ring_pos + 1) % len(self.ring)
+        if self.ring_len < len(self.ring):
+            self.ring_len += 1
+
+    def median(self):
+        ordered = self.ordered
+        size = self.ring_len
+        #insertion sort of the ring copy, the window is small
+        for idx in range(size):
+            value = self.ring[idx]
+            pos = idx
+            while pos and ordered[pos - 1] > value:
+                ordered[pos] = ordered[pos - 1]
+                pos -= 1
+            ordered[pos] = value
+        half = size >> 1
+        if size & 1:
+            return ordered[half]
+        return (ordered[half - 1] + ordered[half] + 1) >> 1
+
+    def to_mv(self, value):
+        return self.max*value//self.range
 
     def periodic(self, cur_time):
         if (cur_time % self.period) == 0:
-            value = self.adc.read()
-            print(value)
-            self.send_value(str(self.max*value/self.range))
+            if not self.count:
+                self.sample()
+            mean = (self.total + (self.count >> 1))//self.count
+            if eventlog.level <= eventlog.DEBUG:
+                eventlog.debug("{} mean {}", self.value_topic, mean)
+            self.report(self.to_mv(mean))
+            self.props[1].report(self.to_mv(self.low))
+            self.props[2].report(self.to_mv(self.high))
+            self.props[3].report(self.to_mv(self.median()))
+            self.reset()
+
+class AnalogSampler:
+    """Samples one analog input per call, the inputs in turn, so each one is
+    read at the same rate and never right after itself."""
+
+    def __init__(self, adcs):
+        self.adcs = adcs
+        self.next = 0
+
+    def sample(self):
+        self.adcs[self.next].sample()
+        self.next = (self.next + 1) % len(self.adcs)
+
+def disconnect(mqtt):
+    if mqtt.sock is None:
+        #the device was not created
+        return
+    try:
+        mqtt.disconnect()
+    except OSError:
+        #the broker was already unreachable
+        pass
+
+class BootTimer:
+    """End time (ms after start, BOOT_TICKS by default) of each boot phase, printed
+    when the phase ends, report() gives them as "phase:ms,..." in order."""
+
+    def __init__(self, start=None):
+        self.start = BOOT_TICKS if start is None else start
+        self.phases = []
+
+    def mark(self, phase):
+        elapsed = time.ticks_diff(time.ticks_ms(), self.start)
+        self.phases.append((phase, elapsed))
+        eventlog.info("boot {} at {} ms", phase, elapsed)
+
+    def report(self):
+        return ",".join(["{}:{}".format(phase, elapsed) for phase, elapsed in self.phases])
+
+def sensor_nodes():
+    """Environment sensor nodes of the config. The drivers are imported only when
+    their sensor is enabled; a sensor, or its bus, failing at setup is logged and
+    left out instead of resetting the board."""
+    nodes = []
+
+    def add(make, *args):
+        try:
+            nodes.append(make(*args))
+        except Exception as excp:
+            eventlog.error("{} setup failed {!r}", make.__name__, excp)
+
+    try:
+        if config["dht"] or config["ds1820"] or config["bme280"]:
+            import env_sensors
+        if config["dht"]:
+            add(env_sensors.EnvironmentDht, Pin(0))
+        elif config["ds1820"]:
+            import onewire, ds18x20
+            ds_driver = ds18x20.DS18X20(onewire.OneWire(Pin(0)))
+            for num, rom in enumerate(ds_driver.scan()):
+                add(env_sensors.EnvironmentDS1820, ds_driver, rom, num)
+        elif config["bme280"]:
+            if config["esp32"]:
+                i2c = I2C(0, scl=Pin(22), sda=Pin(21))
+            else:
+                i2c = I2C(scl=Pin(16), sda=Pin(0))
+            bme_addrs = [addr for addr in i2c.scan() if addr == 0x76 or addr == 0x77]
+            for num, addr in enumerate(bme_addrs):
+                add(env_sensors.EnvironmentBME280, i2c, addr, num)
+    except Exception as excp:
+        eventlog.error("sensor bus setup failed {!r}", excp)
+    return nodes
 
 def homie_broadcast_cb(topic, value, retained):
-    print("broadcast :", topic, value, retained)
+    eventlog.info("broadcast {} {} {}", topic, value, retained)
 
 def main_loop():
 
     init_done = False
-
-    ntptime.host = "fr.pool.ntp.org"
-    ntptime.settime()
+    boot = BootTimer()
 
     try:
         with open("config.json", "rt") as cfg_file:
              config.update( ujson.loads( cfg_file.read() ) )
     except OSError:
         pass
+    eventlog.level = eventlog.LEVELS[config["log_level"]]
+    eventlog.flash_level = eventlog.LEVELS[config["flash_log_level"]]
+    boot.mark("config")
+
+    #created before anything can fail, the connection is only opened by the device
+    mqtt = robust.MQTTClient(config["client_id"], config["broker"], keepalive=4*homie.KEEP_ALIVE)
 
     try:
-        #create the pwm channels
+        #stage 1, local: the pwm channels, buttons and effects run before the network is set up
         pwm0 = PWM(Pin(12), duty=0)
         pwm0.freq(150)
         pwm1 = PWM(Pin(13), duty=0)
@@ -163,110 +444,174 @@ def main_loop():
         else:
             pwm2 = PWM(Pin(15), duty=0)
 
-        #create dht if it is enabled in config
-        if config["dht"]:
-            env_nodes = [env_sensors.EnvironmentDht(Pin(0))]
-        elif config["ds1820"]:
-            import onewire, ds18x20
-            ds_driver = ds18x20.DS18X20(onewire.OneWire(Pin(0)))
-            env_nodes = [env_sensors.EnvironmentDS1820(ds_driver, rom, num) for num, rom in enumerate(ds_driver.scan())]
-        elif config["bme280"]:
-            if config["esp32"]:
-                i2c = I2C(0, scl=Pin(22), sda=Pin(21))
-            else:
-                i2c = I2C(scl=Pin(16), sda=Pin(0))
-            devices = i2c.scan()
-            bme_addrs = [addr for addr in devices if addr == 0x76 or addr == 0x77]
-            env_nodes = [env_sensors.EnvironmentBME280(i2c, addr, num) for num, addr in enumerate(bme_addrs)]
-        else:
-            env_nodes = []
-
-        adcs = []
-        #check in config for analog period
-        analog_period = config['analog_period']
-        analog2_period = config['analog2_period']
+        fader = transition.Fader()
         if config["esp32"]:
-            if analog_period != 0:
-                adcs.append(Analog("analog1", "Analog sensor 1", 34, analog_period, config["analog_bits"], config["analog_attn"]))
-            if analog2_period != 0:
-                adcs.append(Analog("analog2", "Analog sensor 2", 35, analog2_period, config["analog2_bits"], config["analog2_attn"]))
+            dimmers = [ Dimmer("A", pwm0, 32, fader), Dimmer("B", pwm1, 33, fader),
+                        Dimmer("C", pwm2, 25, fader), Dimmer("D", pwm3, 26, fader) ]
         else:
-            if analog_period != 0:
-                adcs.append(Analog("analog1", "Analog sensor 1", 0, analog_period))
+            dimmers = [ Dimmer("A", pwm0, 4, fader), Dimmer("B", pwm1, 5, fader), Dimmer("C", pwm2, 14, fader) ]
 
-        #create the buttons and pwm channels
+        color_manager = ColorManager(dimmers, fader)
 
-        if config["esp32"]:
-            dimmers = [ Dimmer("A", pwm0, 32), Dimmer("B", pwm1, 33),
-                        Dimmer("C", pwm2, 25), Dimmer("D", pwm3, 26) ]
-        else:
-            dimmers = [ Dimmer("A", pwm0, 4), Dimmer("B", pwm1, 5), Dimmer("C", pwm2, 14) ]
+        #the levels and cycler mode before the reset are back before any network activity
+        saved_state = snapshot.Snapshot(dimmers, color_manager, config["snapshot_flash_s"]*1000)
+        restored = saved_state.restore()
+        if restored:
+            eventlog.info("state restored from {}", restored)
 
-        color_manager = ColorManager(dimmers)
-
-        nodes = [ homie.Node("color", "Color leds (on ABC)", color_manager.props), homie.Node("dimmer", "Dimmers channels", dimmers)]
-
-        if env_nodes:
-            nodes.extend(env_nodes)
+        def check_buttons():
+            for dimmer in dimmers:
+                dimmer.periodic()
 
-        if adcs:
-            nodes.append(homie.Node("analog_sens", "Analog Sensors", adcs))
+        loop_stats = None
+        if config["stats_period"]:
+            import stats
+            loop_stats = stats.LoopStats(STAGES)
+
+        #the ESP8266 watchdog has a short fixed timeout (no timeout argument), it is left off;
+        #a started ESP32 watchdog cannot be stopped, it would reset the board at the REPL in debug mode
+        watchdog_ms = config["watchdog_s"]*1000 if config["esp32"] and not config["debug"] else 0
+        tasks = scheduler.Scheduler(loop_stats, watchdog_ms)
+        tasks.every("cycler", ColorManager.PERIOD, color_manager.do_cycle)
+        tasks.every("fader", transition.FRAME_MS, fader.frame)
+        tasks.every("buttons", Dimmer.PERIOD, check_buttons)
+        tasks.every("log", LOG_PERIOD, eventlog.periodic)
+        tasks.every("snapshot", SNAPSHOT_PERIOD, saved_state.periodic)
 
         init_done = True
+        boot.mark("local")
 
-        #~ robust.MQTTClient.DEBUG = True
-
-        #create the mqtt client using config parameters
-        mqtt = robust.MQTTClient(config["client_id"], config["broker"], keepalive=4*homie.KEEP_ALIVE)
-
-        device = homie.HomieDevice( mqtt, ubinascii.hexlify(network.WLAN().config('mac')), nodes, "Multicontroler{}".format(config["location"]), homie_broadcast_cb)
-
-        time_tmp = 0
-
-        while True:
-            device.main()
-            time.sleep(.050)
-
-            cur_time = int(time.time())
+        async def network_up():
+            """Stage 2, sensors, clock and broker session, then the jobs needing the device."""
+            #the local jobs run once before the slower setup
+            await scheduler.sleep_ms(0)
 
-            color_manager.do_cycle()
+            env_nodes = sensor_nodes()
 
-            #this simple test enables to get in this loop only once per second
-            if time_tmp != cur_time:
-                #~ print("In the loop")
-                time_tmp = cur_time
-
-                for env_node in env_nodes:
-                    env_node.periodic(cur_time)
-
-                #analog publication period is user defined
-                for adc in adcs:
-                    adc.periodic(cur_time)
-
-            #buttons checks
-            for dimmer in dimmers:
-                dimmer.periodic()
+            adcs = []
+            #check in config for analog period
+            analog_period = config['analog_period']
+            analog2_period = config['analog2_period']
+            if config["esp32"]:
+                if analog_period != 0:
+                    adcs.append(Analog("analog1", "Analog sensor 1", 34, analog_period, config["analog_bits"], config["analog_attn"], config["analog_window"]))
+                if analog2_period != 0:
+                    adcs.append(Analog("analog2", "Analog sensor 2", 35, analog2_period, config["analog2_bits"], config["analog2_attn"], config["analog_window"]))
+            else:
+                if analog_period != 0:
+                    adcs.append(Analog("analog1", "Analog sensor 1", 0, analog_period, window=config["analog_window"]))
+
+            scene_manager = SceneManager(dimmers, color_manager, fader)
+            nodes = [ homie.Node("color", "Color leds (on ABC)", color_manager.props), homie.Node("dimmer", "Dimmers channels", dimmers),
+                      homie.Node("scene", "Scenes on all channels", scene_manager.props)]
+
+            if env_nodes:
+                nodes.extend(env_nodes)
+
+            if adcs:
+                nodes.append(homie.Node("analog_sens", "Analog Sensors", [prop for adc in adcs for prop in adc.props]))
+
+            #reporting policies of the measures, by property id
+            for node in nodes:
+                for prop in node.properties:
+                    policy = config["report"].get(prop.meta[0])
+                    if policy:
+                        prop.set_report(**policy)
+
+            if loop_stats:
+                diagnostics = stats.Diagnostics(loop_stats)
+                nodes.append(diagnostics)
+            boot.mark("sensors")
+
+            #the clock is set in the background, the measures are timestamped once it is
+            started = []
+            def clock_synced():
+                if measures:
+                    measures.synced = True
+                if "ntp" not in [phase for phase, elapsed in boot.phases]:
+                    boot.mark("ntp")
+                    for device in started:
+                        device.publish_stat("boot", boot.report())
+            ntp_clock = None
+            if config["ntp_host"]:
+                import clock
+                ntp_clock = clock.Clock(config["ntp_host"], clock_synced, clock.GROUP_RESYNC_MS if config["groups"] else clock.RESYNC_MS)
+
+            measures = None
+            if config["history_size"]:
+                import history
+                measures = history.History(config["history_size"], config["history_spill"])
+
+            broadcast_cb = homie_broadcast_cb
+            if config["groups"]:
+                import groups
+                device_groups = groups.Groups(config["groups"], ntp_clock)
+                broadcast_cb = device_groups.on_broadcast
+
+            #connected and advertised by its mqtt job, a broker unreachable at boot
+            #is tried again in the background like after a connection loss
+            device = homie.HomieDevice( mqtt, ubinascii.hexlify(network.WLAN().config('mac')), nodes, "Multicontroler{}".format(config["location"]), broadcast_cb,
+                                        config["mqtt_inflight"], config["force_advert"], measures, config["offline_queue"])
+
+            async def device_ready():
+                while not device.started:
+                    await scheduler.sleep_ms(MQTT_PERIOD)
+                boot.mark("ready")
+                device.publish_stat("boot", boot.report())
+                crash = eventlog.last_crash()
+                if crash:
+                    device.publish_stat("crash", crash)
+                started.append(device)
+
+            def every_second(elems):
+                """calls elems periodic methods once per second, with the current time"""
+                last = [0]
+                def sample():
+                    cur_time = int(time.time())
+                    if last[0] != cur_time:
+                        last[0] = cur_time
+                        for elem in elems:
+                            elem.periodic(cur_time)
+                return sample
+
+            first = len(tasks.jobs)
+            tasks.every("mqtt", MQTT_PERIOD, device.main)
+            if ntp_clock:
+                tasks.every("clock", CLOCK_PERIOD, ntp_clock.step)
+            if env_nodes:
+                import env_sensors
+                tasks.every("sensors", SENSORS_PERIOD, env_sensors.SensorScheduler(env_nodes, config["sensor_period"]*1000).run)
+            #analog publication period is user defined
+            tasks.every("adc", SENSORS_PERIOD, every_second(adcs))
+            if adcs and config["analog_sample_ms"]:
+                tasks.every("sampling", config["analog_sample_ms"], AnalogSampler(adcs).sample)
+            if config["groups"]:
+                device_groups.device = device
+                tasks.every("groups", transition.FRAME_MS, device_groups.run)
+            if loop_stats:
+                tasks.every("stats", config["stats_period"]*1000, diagnostics.periodic)
+            await tasks.run_jobs(first, device_ready())
+
+        tasks.start(network_up())
 
     except KeyboardInterrupt as excp:
-        print ("Interrupted")
+        eventlog.info("Interrupted")
         sys.print_exception(excp)
 
     except Exception as excp:
-        sys.print_exception(excp)
-        with open("exceptions.txt", "at") as excp_file:
-            excp_file.write(str(RTC().datetime()))
-            excp_file.write(" GMT\n")
-            sys.print_exception(excp, excp_file)
-            excp_file.write("\n")
+        #bounded, published as $stats/crash after the next boot
+        eventlog.crash(excp)
 
         #if debug mode is not enabled in config automatic reset in 10 seconds
         if config['debug'] == False and init_done == True:
-            mqtt.disconnect()
+            disconnect(mqtt)
             for count in range (10,0, -1):
                 print("Reboot in {} seconds\r".format(count))
                 time.sleep(1)
             reset()
     finally:
-        mqtt.disconnect()
+        eventlog.flush()
+        disconnect(mqtt)
 
-main_loop()
+if __name__ == "__main__":
+    main_loop()
@@ -0,0 +1,289 @@
+import time
+import usocket
+import uselect
+import uerrno
+from umqtt import simple
+
+import eventlog
+
+RETRY_MS = 2000
+#unacknowledged publications sent again this many times mean a half open connection
+MAX_RETRIES = 3
+#connection attempts are spaced by BACKOFF_MIN_MS, doubled after each failure up to BACKOFF_MAX_MS
+BACKOFF_MIN_MS = 1000
+BACKOFF_MAX_MS = 60000
+#time allowed to open the socket and get the CONNACK
+CONNECT_TIMEOUT_MS = 5000
+
+#Connector states
+IDLE = 0
+CONNECTING = 1
+WAIT_CONNACK = 2
+CONNECTED = 3
+
+
+def encode_len(size):
+    out = bytearray()
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        out.append(byte | 0x80 if size else byte)
+        if not size:
+            return bytes(out)
+
+
+def encode_str(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return bytes((len(value) >> 8, len(value) & 0xFF)) + value
+
+
+def connect_packet(mqtt, clean_session):
+    """CONNECT packet umqtt.simple connect() sends for the client settings."""
+    flags = clean_session << 1
+    payload = encode_str(mqtt.client_id)
+    if mqtt.lw_topic:
+        flags |= 0x4 | (mqtt.lw_qos & 0x1) << 3 | (mqtt.lw_qos & 0x2) << 3 | mqtt.lw_retain << 5
+        payload += encode_str(mqtt.lw_topic) + encode_str(mqtt.lw_msg)
+    if mqtt.user is not None:
+        flags |= 0xC0
+        payload += encode_str(mqtt.user) + encode_str(mqtt.pswd)
+    body = b"\x00\x04MQTT\x04" + bytes((flags, mqtt.keepalive >> 8, mqtt.keepalive & 0xFF)) + payload
+    return b"\x10" + encode_len(len(body)) + body
+
+
+def subscribe_packet(pid, topic, qos):
+    body = bytes((pid >> 8, pid & 0xFF)) + encode_str(topic) + bytes((qos,))
+    return b"\x82" + encode_len(len(body)) + body
+
+
+def read_msg(mqtt):
+    """check_msg of umqtt.simple: errors are raised instead of making the
+    robust client reconnect (blocking) in the middle of the loop."""
+    mqtt.sock.setblocking(False)
+    return simple.MQTTClient.wait_msg(mqtt)
+
+
+def write_header(sock, hdr, flags, topic, size):
+    """Writes the fixed header, remaining length and topic of a PUBLISH whose
+    variable part (packet id and payload) is size bytes, using the hdr buffer
+    (7 bytes) instead of building the packet."""
+    hdr[0] = flags
+    sz = 2 + len(topic) + size
+    i = 1
+    while sz > 0x7F:
+        hdr[i] = (sz & 0x7F) | 0x80
+        sz >>= 7
+        i += 1
+    hdr[i] = sz
+    hdr[i + 1] = len(topic) >> 8
+    hdr[i + 2] = len(topic) & 0xFF
+    sock.write(hdr, i + 3)
+    sock.write(topic)
+
+
+def write_publish(sock, hdr, topic, msg, size, retain):
+    """QoS 0 PUBLISH of the size first bytes of msg."""
+    write_header(sock, hdr, 0x30 | retain, topic, size)
+    sock.write(msg, size)
+
+
+class PublishWindow:
+    """Keeps up to size QoS 1 publications in flight instead of waiting for
+    each PUBACK like umqtt does.
+
+    Packets are written directly on the client socket, PUBACKs are matched by
+    packet id when incoming traffic is read through poll(). Unacknowledged
+    packets are sent again (with the DUP flag) after RETRY_MS, and by
+    resend() once the client has reconnected. A packet still not
+    acknowledged after MAX_RETRIES retries means the connection is half open
+    (nothing comes back from the broker any more), poll() raises OSError
+    ETIMEDOUT. The device publishes $state every KEEP_ALIVE seconds with
+    QoS 1, so this is noticed even when nothing else is published.
+
+    Every read on the client socket must go through poll() while the window
+    is in use, it also reads the SUBACKs of the subscriptions made with
+    subscribe(): the topics not acknowledged yet are kept in subscribing
+    and have to be subscribed again after a reconnection. Connection
+    errors (OSError) are left to the caller.
+    """
+
+    def __init__(self, mqtt, size):
+        self.mqtt = mqtt
+        self.size = size
+        self.inflight = {}
+        #packet id -> topic of the SUBSCRIBEs waiting for their SUBACK
+        self.subscribing = {}
+        self.hdr = bytearray(7)
+
+    def publish(self, topic, msg, retain):
+        """Returns False, without sending, when the window is full."""
+        if len(self.inflight) >= self.size:
+            self.poll()
+            if len(self.inflight) >= self.size:
+                return False
+        mqtt = self.mqtt
+        pid = mqtt.pid % 0xFFFF + 1
+        mqtt.pid = pid
+        self.inflight[pid] = [topic, msg, retain, time.ticks_ms(), 0]
+        self._send(pid, topic, msg, retain, 0)
+        return True
+
+    def _send(self, pid, topic, msg, retain, dup):
+        sock = self.mqtt.sock
+        pkt = self.hdr
+        write_header(sock, pkt, 0x32 | retain | dup << 3, topic, 2 + len(msg))
+        pkt[0] = pid >> 8
+        pkt[1] = pid & 0xFF
+        sock.write(pkt, 2)
+        sock.write(msg)
+
+    def resend(self):
+        """Sends every in-flight packet again, on a new connection."""
+        now = time.ticks_ms()
+        for pid, entry in self.inflight.items():
+            entry[3] = now
+            entry[4] = 0
+            self._send(pid, entry[0], entry[1], entry[2], 1)
+
+    def retry(self):
+        """Sends again the packets not acknowledged within RETRY_MS."""
+        now = time.ticks_ms()
+        for pid, entry in self.inflight.items():
+            if time.ticks_diff(now, entry[3]) >= RETRY_MS:
+                if entry[4] >= MAX_RETRIES:
+                    raise OSError(uerrno.ETIMEDOUT)
+                entry[3] = now
+                entry[4] += 1
+                self._send(pid, entry[0], entry[1], entry[2], 1)
+
+    def subscribe(self, topic):
+        """QoS 1 subscription to topic, not counted in the window."""
+        mqtt = self.mqtt
+        pid = mqtt.pid % 0xFFFF + 1
+        mqtt.pid = pid
+        self.subscribing[pid] = topic
+        mqtt.sock.write(subscribe_packet(pid, topic, 1))
+
+    def free(self):
+        return self.size - len(self.inflight)
+
+    def poll(self):
+        """Reads every pending incoming packet, returns True if something was read."""
+        mqtt = self.mqtt
+        read = False
+        while True:
+            op = read_msg(mqtt)
+            if op is None:
+                break
+            read = True
+            if op == 0x40:
+                sz = mqtt.sock.read(1)
+                assert sz == b"\x02"
+                pid = mqtt.sock.read(2)
+                self.inflight.pop(pid[0] << 8 | pid[1], None)
+            elif op == 0x90:
+                #SUBACK
+                sz = mqtt.sock.read(1)
+                pid = mqtt.sock.read(sz[0])
+                self.subscribing.pop(pid[0] << 8 | pid[1], None)
+        if self.inflight:
+            self.retry()
+        return read
+
+
+class Connector:
+    """Connects the umqtt client to the broker without ever blocking.
+
+    step() is called from the loop while offline, each call does what can be
+    done at once: open a non blocking socket, check with poll() that it is
+    connected, send CONNECT, read the CONNACK. A failure (or no CONNACK
+    within CONNECT_TIMEOUT_MS) schedules the next attempt after the backoff
+    delay, doubled after each failure.
+
+    The first connection is made with a clean session and closed at once,
+    the following ones keep the fresh session (clean_session 0) so the
+    broker keeps the subscriptions over a reconnection. The broker address
+    is resolved once, the only blocking call.
+    """
+
+    def __init__(self, mqtt):
+        self.mqtt = mqtt
+        self.state = IDLE
+        self.clean = True
+        self.addr = None
+        self.backoff = BACKOFF_MIN_MS
+        self.retry_at = time.ticks_ms()
+        self.deadline = 0
+        self.poller = None
+        #CONNACK bytes read so far, a non blocking read may return part of it
+        self.connack = b""
+
+    def lost(self):
+        """The connection failed, next attempt after the backoff delay."""
+        try:
+            self.mqtt.sock.close()
+        except OSError:
+            pass
+        self.poller = None
+        self.state = IDLE
+        self.retry_at = time.ticks_add(time.ticks_ms(), self.backoff)
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX_MS)
+
+    def step(self):
+        """Returns the CONNACK session present flag (0 or 1) once connected, None until then."""
+        mqtt = self.mqtt
+        now = time.ticks_ms()
+        try:
+            if self.state == IDLE:
+                if time.ticks_diff(now, self.retry_at) < 0:
+                    return None
+                sock = usocket.socket()
+                sock.setblocking(False)
+                mqtt.sock = sock
+                try:
+                    if not self.addr:
+                        self.addr = usocket.getaddrinfo(mqtt.server, mqtt.port)[0][-1]
+                    sock.connect(self.addr)
+                except OSError as excp:
+                    if excp.args[0] != uerrno.EINPROGRESS:
+                        raise
+                self.poller = uselect.poll()
+                self.poller.register(sock, uselect.POLLOUT)
+                self.deadline = time.ticks_add(now, CONNECT_TIMEOUT_MS)
+                self.state = CONNECTING
+            elif self.state == CONNECTING:
+                events = self.poller.poll(0)
+                if events:
+                    if events[0][1] & (uselect.POLLERR | uselect.POLLHUP):
+                        raise OSError(uerrno.ECONNREFUSED)
+                    self.poller = None
+                    mqtt.sock.write(connect_packet(mqtt, self.clean))
+                    self.connack = b""
+                    self.state = WAIT_CONNACK
+            else:
+                resp = mqtt.sock.read(4 - len(self.connack))
+                if resp == b"":
+                    raise OSError(uerrno.ECONNRESET)
+                if resp:
+                    resp = self.connack = self.connack + resp
+                    if len(resp) == 4:
+                        if resp[0] != 0x20 or resp[1] != 0x02 or resp[3] != 0:
+                            raise OSError(uerrno.ECONNREFUSED)
+                        if self.clean:
+                            #DISCONNECT, then connect again at once keeping the session
+                            self.clean = False
+                            mqtt.sock.write(b"\xe0\x00")
+                            mqtt.sock.close()
+                            self.state = IDLE
+                            self.retry_at = now
+                            return None
+                        self.state = CONNECTED
+                        self.backoff = BACKOFF_MIN_MS
+                        return resp[2] & 1
+            if time.ticks_diff(now, self.deadline) >= 0:
+                raise OSError(uerrno.ETIMEDOUT)
+        except OSError as excp:
+            eventlog.warning("MQTT connection failed {}", excp)
+            self.lost()
+        return None
@@ -0,0 +1,124 @@
+import time
+from micropython import const
+
+import eventlog
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:
+    def sleep_ms(delay):
+        return asyncio.sleep(delay / 1000)
+
+#a failing job is run again after RESTART_MIN_MS, doubled after each failure up to RESTART_MAX_MS
+RESTART_MIN_MS = const(1000)
+RESTART_MAX_MS = const(60000)
+#a job not run STALL_MS after its deadline is restarted
+STALL_MS = const(5000)
+
+
+class Scheduler:
+    """Runs every registered job in its own uasyncio task at its own period.
+
+    The uasyncio run queue is the timer heap: a job sleeps until its next
+    deadline so the CPU idles in the event loop between deadlines. Deadlines
+    are computed from the previous one (not from the end of the call) so a
+    job does not drift, a job overrunning its period is run again at once
+    and its late periods are dropped. A job returning a delay (ms) is run
+    again after it instead (the clock polling a pending answer).
+
+    When a stats.LoopStats is given, the lateness and duration of every call
+    are recorded under the job name.
+
+    Coroutines given to start() run next to the jobs, they can register jobs
+    later on and run them with run_jobs() (a staged boot for instance).
+
+    Jobs are supervised: an exception raised by a job is logged and the job
+    is run again after a backoff delay, the other jobs keep running. With
+    watchdog_ms, start() also starts the hardware watchdog, fed by the
+    "watchdog" job only while every running job meets its deadlines, a job
+    whose task stopped is restarted. When the loop itself is stuck (a
+    blocking call never returning) nothing feeds the watchdog any more and
+    the board resets.
+    """
+
+    def __init__(self, stats=None, watchdog_ms=0):
+        self.jobs = []
+        self.stats = stats
+        self.watchdog_ms = watchdog_ms
+        self.wdt = None
+        #per job: next deadline (None until its task runs), task generation, restart delay
+        self.due = []
+        self.generation = []
+        self.backoff = []
+        self.supervised = time.ticks_ms()
+
+    def every(self, name, period_ms, func, *args):
+        self.jobs.append((name, self.stats.names.index(name) if self.stats else -1, period_ms, func, args))
+        self.due.append(None)
+        self.generation.append(0)
+        self.backoff.append(RESTART_MIN_MS)
+
+    async def periodic(self, job, generation=0):
+        name, idx, period_ms, func, args = self.jobs[job]
+        stats = self.stats
+        deadline = time.ticks_ms()
+        #a restarted job leaves the task it replaces
+        while self.generation[job] == generation:
+            try:
+                if stats:
+                    late = time.ticks_diff(time.ticks_ms(), deadline)
+                    start = time.ticks_us()
+                    after = func(*args)
+                    stats.record(idx, late, time.ticks_diff(time.ticks_us(), start))
+                else:
+                    after = func(*args)
+                self.backoff[job] = RESTART_MIN_MS
+            except Exception as excp:
+                after = self.backoff[job]
+                eventlog.error("job {} failed, run again in {} ms: {!r}", name, after, excp)
+                self.backoff[job] = min(after * 2, RESTART_MAX_MS)
+            if after is None:
+                deadline = time.ticks_add(deadline, period_ms)
+            else:
+                deadline = time.ticks_add(time.ticks_ms(), after)
+            delay = time.ticks_diff(deadline, time.ticks_ms())
+            if delay < 0:
+                deadline = time.ticks_ms()
+                delay = 0
+            self.due[job] = deadline
+            await sleep_ms(delay)
+
+    def supervise(self):
+        """Feeds the watchdog when every running job met its deadline, restarts the stalled ones."""
+        now = time.ticks_ms()
+        #after a long blocking call (a DNS lookup) every job is late, none stalled
+        blocked = time.ticks_diff(now, self.supervised) > self.watchdog_ms // 4 + STALL_MS
+        self.supervised = now
+        healthy = True
+        for job, due in enumerate(self.due):
+            if due is not None and not blocked and time.ticks_diff(now, due) > STALL_MS:
+                healthy = False
+                eventlog.error("job {} stalled, restarted", self.jobs[job][0])
+                self.generation[job] += 1
+                self.due[job] = now
+                asyncio.create_task(self.periodic(job, self.generation[job]))
+        if healthy and self.wdt:
+            self.wdt.feed()
+
+    async def run_jobs(self, first=0, *coros):
+        """Runs the jobs registered from index first forever, next to coros."""
+        #a single * argument, older MicroPython compilers refuse several
+        await asyncio.gather(*([self.periodic(job) for job in range(first, len(self.jobs))] + list(coros)))
+
+    def start(self, *coros):
+        if self.watchdog_ms:
+            from machine import WDT
+            self.wdt = WDT(timeout=self.watchdog_ms)
+            #fed several times per timeout
+            self.every("watchdog", self.watchdog_ms // 4, self.supervise)
+        asyncio.run(self.run_jobs(0, *coros))
@@ -0,0 +1,87 @@
+"""Host side simulation of the controller.
+
+install() makes the MicroPython only modules imported by main.py, homie.py
+and env_sensors.py importable on CPython (and the unix port): the
+stand-ins of sim.modules are registered in sys.modules under their board
+names, the CPython time, gc and sys modules get the MicroPython extensions
+used by the code. The boards drive virtual hardware (sim.hw) and talk to
+the in process broker of sim.broker.
+"""
+import gc
+import sys
+import time
+
+STANDINS = ("machine", "network", "uselect", "usocket", "umqtt", "umqtt.simple",
+            "robust", "dht", "bme280", "onewire", "ds18x20")
+#modules only replaced when the interpreter does not provide them
+ALIASES = (("micropython", "sim.modules.micropython"), ("ubinascii", "binascii"), ("ujson", "json"), ("uhashlib", "hashlib"), ("ustruct", "struct"),
+           ("uarray", "array"), ("utime", "time"), ("uerrno", "errno"), ("uio", "io"), ("uos", "os"))
+
+TICKS_PERIOD = 1 << 30
+TICKS_HALF = TICKS_PERIOD >> 1
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) & (TICKS_PERIOD - 1)
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) & (TICKS_PERIOD - 1)
+
+
+def ticks_add(ticks, delta):
+    if not -TICKS_HALF <= delta < TICKS_HALF:
+        raise OverflowError("ticks interval overflow")
+    return (ticks + delta) & (TICKS_PERIOD - 1)
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALF) & (TICKS_PERIOD - 1)) - TICKS_HALF
+
+
+def sleep_ms(delay):
+    time.sleep(delay / 1000)
+
+
+def sleep_us(delay):
+    time.sleep(delay / 1000000)
+
+
+def print_exception(excp, file=sys.stdout):
+    import traceback
+    traceback.print_exception(type(excp), excp, excp.__traceback__, file=file)
+
+
+def load(name):
+    module = __import__(name)
+    for part in name.split(".")[1:]:
+        module = getattr(module, part)
+    return module
+
+
+def mem_free():
+    return 100000
+
+
+def mem_alloc():
+    return 0
+
+
+def install():
+    if not hasattr(time, "ticks_ms"):
+        for func in (ticks_ms, ticks_us, ticks_add, ticks_diff, sleep_ms, sleep_us):
+            setattr(time, func.__name__, func)
+    if not hasattr(gc, "mem_free"):
+        gc.mem_free = mem_free
+        gc.mem_alloc = mem_alloc
+    if not hasattr(sys, "print_exception"):
+        sys.print_exception = print_exception
+    for alias, name in ALIASES:
+        try:
+            __import__(alias)
+        except ImportError:
+            sys.modules[alias] = load(name)
+    for name in STANDINS:
+        sys.modules[name] = load("sim.modules." + name)
+    from sim import broker
+    return broker.BROKER
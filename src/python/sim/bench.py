@@ -0,0 +1,429 @@
+"""Benchmarks of the device hot paths on the simulated hardware.
+
+Run from src/python with CPython or the MicroPython unix port:
+
+    python -m sim.bench [--update] [--baseline FILE] [--runs N]
+    micropython -m sim.bench
+
+For every case the time per call, the bytes allocated per call and the
+garbage collections triggered are compared to the baseline stored for the
+running implementation, --update stores the new results instead. The
+exit code is 1 when a case regressed. The stored file has the CPython
+baseline, the unix port one is added by running micropython -m sim.bench
+--update, until then its results are only printed.
+
+Each of the REPEATS passes of --runs calls of a case follows a pass of a
+fixed reference workload, the pass where the case is the fastest relative
+to its reference gives the time per call. It is compared to the baseline
+scaled by the reference times, so a slower or busier host does not show
+as a regression. A slow down is reported beyond TIME_TOLERANCE and
+TIME_FLOOR_US, so the scheduling noise on microsecond cases is not either,
+and only if it is still seen after ATTEMPTS measures of the case.
+The files written by the device (advertisement digest, event log) go to a
+temporary directory. The device is advertised on the in process broker,
+then its publications are dropped (see Sink).
+
+Allocations are exact on MicroPython (gc.mem_alloc with the collector
+disabled). CPython frees most objects at once, the tracemalloc peak of each
+call is reported instead, it still shows when a path starts building objects.
+
+The heap kept per property by an exposed node tree (metadata, topics,
+routes, driver state) is reported as "Property tree".
+"""
+import gc
+import json
+import os
+import sys
+import time
+
+import sim
+from sim import hw
+
+BASELINE = "sim/bench_baseline.json"
+RUNS = 1000
+#passes of RUNS calls, the fastest one gives the time per call
+REPEATS = 5
+#relative and absolute (us) slow down, and extra bytes per call, tolerated before reporting a regression
+TIME_TOLERANCE = 0.5
+TIME_FLOOR_US = 1.0
+#a case regressing is measured again, up to ATTEMPTS times, before being reported
+ATTEMPTS = 3
+ALLOC_TOLERANCE = 16
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def implementation():
+    return sys.implementation.name
+
+
+def collections():
+    if hasattr(gc, "get_stats"):
+        return sum(stat["collections"] for stat in gc.get_stats())
+    return 0
+
+
+def nothing():
+    pass
+
+
+def reference():
+    """Fixed interpreted work, the unit of the compared times."""
+    total = 0
+    for idx in range(50):
+        total += idx * idx & 0xFF
+    return total
+
+
+def traced_peak(func, runs):
+    alloc = 0
+    tracemalloc.start()
+    for _ in range(runs):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        alloc += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return alloc / runs
+
+
+def pass_time(func, runs):
+    """us per call of a pass of runs calls."""
+    gc.collect()
+    start = time.ticks_us()
+    for _ in range(runs):
+        func()
+    return time.ticks_diff(time.ticks_us(), start) / runs
+
+
+def paired_time(func, runs):
+    """(us per call, reference us per call) of the pass, among REPEATS, where
+    func was the fastest relative to the reference timed right before it."""
+    best = None
+    for _ in range(REPEATS):
+        ref = pass_time(reference, runs)
+        usec = pass_time(func, runs)
+        if best is None or usec * best[1] < best[0] * ref:
+            best = (usec, ref)
+    return best
+
+
+def measure(func, runs):
+    """Returns (us per call, reference us per call, bytes allocated per call,
+    collections triggered)."""
+    gc.collect()
+    if tracemalloc:
+        start_gcs = collections()
+        for _ in range(runs):
+            func()
+        gcs = collections() - start_gcs
+        alloc = traced_peak(func, runs) - traced_peak(nothing, runs)
+        return paired_time(func, runs) + (alloc, gcs)
+
+    #MicroPython: a collection is seen as a drop of the allocated heap
+    gcs = 0
+    last = gc.mem_alloc()
+    for _ in range(runs):
+        func()
+        now = gc.mem_alloc()
+        if now < last:
+            gcs += 1
+        last = now
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    for _ in range(runs):
+        func()
+    alloc = gc.mem_alloc() - before
+    gc.enable()
+    return paired_time(func, runs) + (alloc / runs, gcs)
+
+
+class Sink:
+    """Client socket of the measured device once advertised: what it writes is
+    dropped and nothing comes in, the cases time the device code and not the
+    delivery by the in process broker."""
+
+    def write(self, data, size=None):
+        return len(data) if size is None else size
+
+    def read(self, size):
+        return None
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+
+class Advertiser:
+    """Stands for the HomieDevice when exposing a tree, nothing is published."""
+
+    def __init__(self):
+        self.full_advert = False
+        self.set_routes = {}
+        self.props = []
+
+    def publish(self, topic, value, qos=1, retained=True):
+        return "/".join(topic)
+
+    def publish_attributes(self, base_list, attributes):
+        pass
+
+
+def make_nodes():
+    """Creates the nodes of an ESP32 with every sensor type, like main_loop does."""
+    import homie
+    import env_sensors
+    import transition
+    import onewire
+    import ds18x20
+    from machine import Pin, PWM, I2C
+    import main
+
+    fader = transition.Fader()
+    dimmers = [main.Dimmer(name, PWM(Pin(pwm_pin), duty=0), bt_pin, fader)
+               for name, pwm_pin, bt_pin in (("A", 12, 32), ("B", 13, 33), ("C", 2, 25), ("D", 4, 26))]
+    color_manager = main.ColorManager(dimmers, fader)
+    dht_node = env_sensors.EnvironmentDht(Pin(0))
+    ds_driver = ds18x20.DS18X20(onewire.OneWire(Pin(0)))
+    ds_node = env_sensors.EnvironmentDS1820(ds_driver, ds_driver.scan()[0], 1)
+    bme_node = env_sensors.EnvironmentBME280(I2C(0), 0x76, 2)
+    adc = main.Analog("analog1", "Analog sensor 1", 34, 1)
+    nodes = [homie.Node("color", "Color leds (on ABC)", color_manager.props), homie.Node("dimmer", "Dimmers channels", dimmers),
+             dht_node, ds_node, bme_node, homie.Node("analog_sens", "Analog Sensors", adc.props)]
+    return nodes, color_manager, dimmers, dht_node, ds_node, bme_node, adc, fader
+
+
+def setup():
+    broker = sim.install()
+    hw.i2c_devices.append(0x76)
+    hw.onewire_roms.append(bytearray(b"\x28\x00\x00\x00\x00\x00\x00\x01"))
+    hw.adc_values[34] = [100, 900, 400]
+
+    #every module is loaded before measuring the footprint
+    import homie
+    import env_sensors
+    import onewire
+    import ds18x20
+    import main
+    main.config["esp32"] = True
+    main.config["publish_interval"] = 0
+    return broker
+
+
+def footprint():
+    """Returns (heap bytes kept per property by an exposed tree, property count)."""
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    before = gc.mem_alloc()
+    nodes = make_nodes()[0]
+    advertiser = Advertiser()
+    for node in nodes:
+        for _ in node.expose(advertiser, ["homie", "bench", None]):
+            pass
+    gc.collect()
+    kept = gc.mem_alloc() - before
+    if tracemalloc:
+        kept = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    count = sum([len(node.properties) for node in nodes])
+    return kept / count, count
+
+
+def build(broker):
+    """Creates a device like main_loop does, on an ESP32 with every sensor type."""
+    import homie
+    import robust
+    import main
+
+    nodes, color_manager, dimmers, dht_node, ds_node, bme_node, adc, fader = make_nodes()
+    mqtt = robust.MQTTClient(b"bench", "127.0.0.1", keepalive=4*homie.KEEP_ALIVE)
+    device = homie.HomieDevice(mqtt, b"bench", nodes, "Bench", main.homie_broadcast_cb, 8, True)
+    while not device.started:
+        device.main()
+    device.mqtt.sock = Sink()
+    return broker, device, color_manager, dimmers, dht_node, ds_node, bme_node, adc, fader
+
+
+def cases(broker):
+    broker, device, color_manager, dimmers, dht_node, ds_node, bme_node, adc, fader = build(broker)
+    dimmer = dimmers[0]
+    set_topic = b"homie/bench/dimmer/chan-b/set"
+    temp = bme_node.properties[0]
+    state = {"count": 0}
+
+    def device_main():
+        device.main()
+
+    def subscribe_cb():
+        device.subscribe_cb(set_topic, b"42", False)
+
+    def publish():
+        device.publish(temp.value_topic, "21.5", 0, True)
+
+    def send_value():
+        temp.send_value(215)
+
+    def do_cycle():
+        color_manager.do_cycle()
+
+    def fade_frame():
+        fader.frame()
+
+    def dimmer_periodic():
+        #press and release every 20 calls, the rest is the idle path
+        state["count"] += 1
+        if state["count"] % 20 == 0:
+            hw.press(32)
+        elif state["count"] % 20 == 1:
+            hw.release(32)
+        dimmer.periodic()
+
+    #every call runs the next phase of a measurement, collect phases publish
+    def dht_step():
+        dht_node.step(time.ticks_ms())
+
+    def ds1820_step():
+        ds_node.step(time.ticks_ms())
+
+    def bme280_step():
+        bme_node.step(time.ticks_ms())
+
+    def analog_periodic():
+        adc.periodic(0)
+
+    def analog_sample():
+        adc.sample()
+
+    color_manager.set_cycler(None, "5")
+    for dim in dimmers:
+        fader.fade(dim.channel, 40000, 60000)
+    return [("HomieDevice.main", device_main), ("HomieDevice.subscribe_cb", subscribe_cb),
+            ("HomieDevice.publish", publish), ("Property.send_value", send_value),
+            ("ColorManager.do_cycle", do_cycle), ("Fader.frame", fade_frame), ("Dimmer.periodic", dimmer_periodic),
+            ("EnvironmentDht.step", dht_step), ("EnvironmentDS1820.step", ds1820_step),
+            ("EnvironmentBME280.step", bme280_step), ("Analog.periodic", analog_periodic),
+            ("Analog.sample", analog_sample)]
+
+
+class Quiet:
+    """Drops the console output of the benchmarked code when the port allows it."""
+
+    def write(self, text):
+        return len(text)
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        try:
+            sys.stdout = self
+        except AttributeError:
+            pass
+        return self
+
+    def __exit__(self, *args):
+        try:
+            sys.stdout = self.stdout
+        except AttributeError:
+            pass
+        return False
+
+
+def workdir():
+    """Empty directory for the files written by the benchmarked code."""
+    try:
+        import tempfile
+        return tempfile.mkdtemp(prefix="bench_")
+    except ImportError:
+        #MicroPython unix port
+        path = "/tmp/bench_{}".format(time.ticks_ms())
+        os.mkdir(path)
+        return path
+
+
+def load_baseline(path):
+    try:
+        with open(path) as base_file:
+            return json.load(base_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def compare(name, result, base):
+    """Returns the regression message of the case, None if it did not regress."""
+    if not base:
+        return None
+    usec, ref, alloc, gcs = result
+    if "us" in base:
+        #time the case would take on the host as fast as when the baseline was stored
+        usec = usec * base["ref"] / ref if ref and base.get("ref") else usec
+        if usec > base["us"] * (1 + TIME_TOLERANCE) + TIME_FLOOR_US:
+            return "{}: {:.1f} us per call at the baseline host speed, baseline {:.1f}".format(name, usec, base["us"])
+    if alloc > base["bytes"] + ALLOC_TOLERANCE:
+        return "{}: {:.0f} bytes per call, baseline {:.0f}".format(name, alloc, base["bytes"])
+    if gcs > base.get("gcs", 0):
+        return "{}: {} collections, baseline {}".format(name, gcs, base["gcs"])
+    return None
+
+
+def main(argv):
+    path = BASELINE
+    runs = RUNS
+    update = "--update" in argv
+    if "--baseline" in argv:
+        path = argv[argv.index("--baseline") + 1]
+    if "--runs" in argv:
+        runs = int(argv[argv.index("--runs") + 1])
+
+    if not path.startswith("/"):
+        path = os.getcwd() + "/" + path
+    baselines = load_baseline(path)
+    impl = implementation()
+    baseline = baselines.get(impl, {})
+    os.chdir(workdir())
+    results = {}
+    regressions = []
+    print("{:28} {:>10} {:>10} {:>6}".format("case (" + impl + ")", "us/call", "bytes/call", "gcs"))
+    with Quiet():
+        broker = setup()
+        per_prop, count = footprint()
+        benchs = cases(broker)
+    results["footprint"] = {"bytes": round(per_prop, 1)}
+    print("{:28} {:>10} {:10.1f} ({} properties)".format("Property tree", "", per_prop, count))
+    message = compare("Property tree", (0, 0, per_prop, 0), baseline.get("footprint"))
+    if message:
+        regressions.append(message)
+    for name, func in benchs:
+        base = baseline.get(name)
+        for _ in range(ATTEMPTS):
+            with Quiet():
+                result = measure(func, runs)
+            message = compare(name, result, base)
+            if not message or update:
+                break
+        usec, ref, alloc, gcs = result
+        results[name] = {"us": round(usec, 2), "ref": round(ref, 3), "bytes": round(alloc, 1), "gcs": gcs}
+        print("{:28} {:10.2f} {:10.1f} {:6}".format(name, usec, alloc, gcs))
+        if message:
+            regressions.append(message)
+
+    if update:
+        baselines[impl] = results
+        with open(path, "w") as base_file:
+            json.dump(baselines, base_file, indent=1, sort_keys=True)
+        print("baseline stored in", path)
+        return 0
+    if not baseline:
+        print("no {} baseline in {}, --update stores one".format(impl, path))
+    for message in regressions:
+        print("REGRESSION", message)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,346 @@
+"""In process MQTT 3.1.1 broker for the simulation.
+
+The usocket stand-in connects to BROKER, the broker decodes the packets
+written by the clients as soon as they are written and answers in their
+receive buffer, so a single threaded simulation never waits on the
+network. Every PUBLISH going through the broker is recorded with its
+time in Broker.log.
+"""
+import time
+
+try:
+    import threading
+    Lock = threading.RLock
+    Condition = threading.Condition
+except ImportError:
+    Lock = Condition = None
+
+ECONNREFUSED = 111
+
+
+class NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def wait(self, timeout=None):
+        return False
+
+    def notify_all(self):
+        pass
+
+
+class Record:
+    """One publication seen by the broker."""
+
+    def __init__(self, stamp, client_id, topic, payload, qos, retain):
+        self.time = stamp
+        self.client_id = client_id
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+    def __repr__(self):
+        return "{:.3f} {} {} {!r}".format(self.time, self.client_id, self.topic, self.payload)
+
+    def to_dict(self):
+        return {"time": self.time, "client_id": self.client_id, "topic": self.topic,
+                "payload": self.payload.decode("utf-8", "replace"), "qos": self.qos, "retain": self.retain}
+
+
+def matches(topic_filter, topic):
+    return parts_match(topic_filter.split("/"), topic.split("/"))
+
+
+def parts_match(filter_parts, topic_parts):
+    if topic_parts[0].startswith("$") and filter_parts[0] in ("+", "#"):
+        return False
+    for idx, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if idx >= len(topic_parts) or (part != "+" and part != topic_parts[idx]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def index_key(parts):
+    """Subscriptions are indexed by their first two levels, None when one is a wildcard."""
+    if len(parts) < 2 or parts[0] in ("+", "#") or parts[1] in ("+", "#"):
+        return None
+    return parts[0] + "/" + parts[1]
+
+
+def encode_len(size):
+    out = bytearray()
+    while True:
+        byte = size & 0x7F
+        size >>= 7
+        out.append(byte | 0x80 if size else byte)
+        if not size:
+            return bytes(out)
+
+
+def encode_str(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return bytes((len(value) >> 8, len(value) & 0xFF)) + value
+
+
+class Session:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.subscriptions = {}
+        self.pid = 0
+        self.conn = None
+        #QoS 1 messages received while the persistent session was offline
+        self.queue = []
+
+
+class Connection:
+    """Broker side of a client socket."""
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.buffer = bytearray()
+        self.session = None
+        self.will = None
+        self.open = True
+
+    def send(self, data):
+        if self.open:
+            self.sock.feed(data)
+
+    def receive(self, data):
+        if self.broker.silent:
+            #lost on the way
+            return
+        self.buffer += data
+        while self.open:
+            size = 0
+            shift = 0
+            idx = 1
+            while True:
+                if idx >= len(self.buffer):
+                    return
+                byte = self.buffer[idx]
+                size |= (byte & 0x7F) << shift
+                shift += 7
+                idx += 1
+                if not byte & 0x80:
+                    break
+            if len(self.buffer) < idx + size:
+                return
+            header = self.buffer[0]
+            body = bytes(self.buffer[idx:idx + size])
+            del self.buffer[:idx + size]
+            self.broker.handle(self, header, body)
+
+    def close(self, clean):
+        if not self.open:
+            return
+        self.open = False
+        self.sock.hangup()
+        if self.session and self.session.conn is self:
+            self.session.conn = None
+        if not clean and self.will:
+            self.broker.route(self.session.client_id, *self.will)
+
+
+class Broker:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = Lock() if Lock else NoLock()
+        self.data = Condition(self.lock) if Condition else NoLock()
+        self.online = True
+        #half open connections, see silence()
+        self.silent = False
+        self.connections = []
+        self.sessions = {}
+        self.retained = {}
+        self.log = []
+        self.watchers = []
+        #index key -> [(session, filter parts, qos)], the wildcard filters are under None
+        self.index = {None: []}
+        #index key -> retained topics under it (dict keys, in publication order)
+        self.retained_index = {}
+
+    #client side API
+
+    def accept(self, sock):
+        with self.lock:
+            if not self.online:
+                raise OSError(ECONNREFUSED)
+            conn = Connection(self, sock)
+            self.connections.append(conn)
+            return conn
+
+    #simulation API
+
+    def publish(self, topic, payload, retain=False, qos=0, client_id="sim"):
+        """Publication made by something else than the simulated devices (a controller)."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self.lock:
+            self.route(client_id, topic, payload, qos, retain)
+
+    def watch(self, topic_filter, callback):
+        """callback(record) is called for every publication matching topic_filter."""
+        self.watchers.append((topic_filter, callback))
+
+    def records(self, topic_filter="#"):
+        return [rec for rec in self.log if matches(topic_filter, rec.topic)]
+
+    def stop(self):
+        """Broker outage: connections are dropped (wills are sent) and new ones refused."""
+        with self.lock:
+            self.online = False
+            for conn in list(self.connections):
+                conn.close(False)
+            self.connections = []
+
+    def silence(self):
+        """Network cut without the connections being closed (half open): what the
+        clients write is lost, nothing is answered and new connections are refused."""
+        with self.lock:
+            self.online = False
+            self.silent = True
+
+    def start(self):
+        self.online = True
+        self.silent = False
+
+    #protocol
+
+    def handle(self, conn, header, body):
+        kind = header & 0xF0
+        if kind == 0x10:
+            self.on_connect(conn, body)
+        elif kind == 0x30:
+            self.on_publish(conn, header, body)
+        elif kind == 0x80:
+            self.on_subscribe(conn, body)
+        elif kind == 0xA0:
+            conn.send(b"\xb0\x02" + body[:2])
+        elif kind == 0xC0:
+            conn.send(b"\xd0\x00")
+        elif kind == 0xE0:
+            conn.close(True)
+            self.connections.remove(conn)
+
+    def on_connect(self, conn, body):
+        pos = 2 + (body[0] << 8 | body[1])
+        flags = body[pos + 1]
+        pos += 4
+
+        def read_str():
+            nonlocal pos
+            size = body[pos] << 8 | body[pos + 1]
+            value = body[pos + 2:pos + 2 + size]
+            pos += 2 + size
+            return value
+
+        client_id = read_str().decode("utf-8")
+        if flags & 0x04:
+            will_topic = read_str().decode("utf-8")
+            conn.will = (will_topic, read_str(), flags >> 3 & 0x03, bool(flags & 0x20))
+        session = self.sessions.get(client_id)
+        present = session is not None and not flags & 0x02
+        if not present:
+            if session:
+                self.unindex(session)
+            session = self.sessions[client_id] = Session(client_id)
+        if session.conn:
+            session.conn.close(False)
+        session.conn = conn
+        conn.session = session
+        conn.send(bytes((0x20, 0x02, int(present), 0)))
+        for topic, payload, qos in session.queue:
+            self.deliver(session, topic, payload, qos, False)
+        session.queue = []
+
+    def on_publish(self, conn, header, body):
+        qos = header >> 1 & 0x03
+        size = body[0] << 8 | body[1]
+        topic = body[2:2 + size].decode("utf-8")
+        pos = 2 + size
+        if qos:
+            conn.send(b"\x40\x02" + body[pos:pos + 2])
+            pos += 2
+        self.route(conn.session.client_id, topic, body[pos:], qos, bool(header & 0x01))
+
+    def on_subscribe(self, conn, body):
+        pos = 2
+        granted = bytearray()
+        new = []
+        while pos < len(body):
+            size = body[pos] << 8 | body[pos + 1]
+            topic_filter = body[pos + 2:pos + 2 + size].decode("utf-8")
+            qos = min(body[pos + 2 + size], 1)
+            pos += 3 + size
+            self.subscribe(conn.session, topic_filter, qos)
+            granted.append(qos)
+            new.append((topic_filter, qos))
+        conn.send(b"\x90" + encode_len(2 + len(granted)) + body[:2] + bytes(granted))
+        for topic_filter, qos in new:
+            filter_parts = topic_filter.split("/")
+            key = index_key(filter_parts)
+            topics = self.retained if key is None else self.retained_index.get(key, ())
+            for topic in list(topics):
+                if parts_match(filter_parts, topic.split("/")):
+                    payload, pub_qos = self.retained[topic]
+                    self.deliver(conn.session, topic, payload, min(qos, pub_qos), True)
+
+    def subscribe(self, session, topic_filter, qos):
+        parts = topic_filter.split("/")
+        entries = self.index.setdefault(index_key(parts), [])
+        if topic_filter in session.subscriptions:
+            entries[:] = [entry for entry in entries if entry[0] is not session or entry[1] != parts]
+        session.subscriptions[topic_filter] = qos
+        entries.append((session, parts, qos))
+
+    def unindex(self, session):
+        for key, entries in self.index.items():
+            entries[:] = [entry for entry in entries if entry[0] is not session]
+
+    def route(self, client_id, topic, payload, qos, retain):
+        record = Record(self.clock(), client_id, topic, payload, qos, retain)
+        self.log.append(record)
+        topic_parts = topic.split("/")
+        if retain:
+            topics = self.retained_index.setdefault(index_key(topic_parts), {})
+            if payload:
+                self.retained[topic] = (payload, qos)
+                topics[topic] = None
+            else:
+                self.retained.pop(topic, None)
+                topics.pop(topic, None)
+        #highest QoS of the matching subscriptions of each session
+        granted = {}
+        for entries in (self.index.get(index_key(topic_parts), ()), self.index[None]):
+            for session, filter_parts, qos_max in entries:
+                if parts_match(filter_parts, topic_parts):
+                    granted[session] = max(granted.get(session, -1), qos_max)
+        for session, sub_qos in granted.items():
+            if session.conn:
+                self.deliver(session, topic, payload, min(qos, sub_qos), False)
+            elif min(qos, sub_qos) > 0:
+                session.queue.append((topic, payload, 1))
+        for topic_filter, callback in self.watchers:
+            if matches(topic_filter, topic):
+                callback(record)
+        self.data.notify_all()
+
+    def deliver(self, session, topic, payload, qos, retain):
+        body = encode_str(topic)
+        if qos:
+            session.pid = session.pid % 0xFFFF + 1
+            body += bytes((session.pid >> 8, session.pid & 0xFF))
+        body += payload
+        session.conn.send(bytes((0x30 | qos << 1 | retain,)) + encode_len(len(body)) + body)
+
+
+BROKER = Broker()
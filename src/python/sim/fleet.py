@@ -0,0 +1,239 @@
+"""Fleet of simulated controllers on the in process broker, to size a broker
+and home automation setup before adding controllers, and to catch protocol
+regressions of homie.py.
+
+Run from src/python with CPython:
+
+    python -m sim.fleet --devices 500 --seconds 30 --workers 8 --sets 50 --presses 20
+
+Every device is a real homie.HomieDevice with its own MQTT session (Homie
+needs a last will and subscriptions per device), its nodes mirror main.py:
+the color and dimmer nodes (dimmers without pins) and a BME280 environment
+node measured through env_sensors.SensorScheduler. The devices are shared
+out to a pool of asyncio workers, each one runs HomieDevice.main and the
+sensors of its devices every MQTT period like the device loop.
+
+Meanwhile a controller sends random set commands (--sets per second) and
+the devices see random button presses (--presses per second), the
+environment drifts so the measures change. The report gives the
+advertisement time of the devices, the set to echo latency percentiles and
+the messages per second through the broker. The exit code is 1 when a set
+command was not echoed, or a device did not reach the ready state.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import sim
+from sim import hw
+from sim.bench import Quiet
+
+#loop periods of main.py (ms)
+MQTT_PERIOD = 50
+PUBLISH_INTERVAL = 250
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def make_dimmer_class():
+    import homie
+
+    class VirtualDimmer(homie.Property):
+        """main.Dimmer without PWM and button: the level is kept as a percentage."""
+
+        def __init__(self, dim_id):
+            super().__init__("chan-" + dim_id.lower(), "Dimmer " + dim_id.upper(), "float", "%", "0:100", 0, self.set_value,
+                             min_interval=PUBLISH_INTERVAL)
+            self.level = 0
+            self.last_level = 100
+
+        def set_value(self, topic, value):
+            values = value.split(",")
+            self.level = int(float(values[0]))
+            return values[0]
+
+        def press(self):
+            """Short press: switches on and off like main.Dimmer.periodic."""
+            if self.level == 0:
+                self.level = self.last_level
+            else:
+                self.last_level = self.level
+                self.level = 0
+            self.send_value(self.level)
+
+    return VirtualDimmer
+
+
+class Fleet:
+    def __init__(self, count, sensor_period):
+        self.count = count
+        self.sensor_period = sensor_period
+        self.devices = []
+        #device index -> (dimmers, sensor scheduler)
+        self.parts = []
+        self.advert_times = []
+        #echo topic -> (payload, time) of the last set command not echoed yet
+        self.pending_sets = {}
+        self.latencies = []
+        self.sets = 0
+        #set commands replaced by a newer one before their echo, only the last value of a burst is echoed
+        self.superseded = 0
+        self.ready = set()
+
+    def build(self, broker):
+        import homie
+        import env_sensors
+        import robust
+        from machine import I2C
+
+        VirtualDimmer = make_dimmer_class()
+        start = time.monotonic()
+        for idx in range(self.count):
+            device_id = "fleet{:05}".format(idx).encode()
+            dimmers = [VirtualDimmer(name) for name in "ABCD"]
+            color = [homie.Property("color", "desired color RGB", "color", None, "rgb", "000,000,000", lambda topic, value: True,
+                                    min_interval=PUBLISH_INTERVAL),
+                     homie.Property("cycler", "cycler mode", "integer", None, "0:29", "0", lambda topic, value: True)]
+            env_node = env_sensors.EnvironmentBME280(I2C(0), 0x76, 0)
+            nodes = [homie.Node("color", "Color leds (on ABC)", color), homie.Node("dimmer", "Dimmers channels", dimmers), env_node]
+            mqtt = robust.MQTTClient(device_id, "127.0.0.1", keepalive=4*homie.KEEP_ALIVE)
+            begin = time.monotonic()
+            device = homie.HomieDevice(mqtt, device_id, nodes, "Fleet {}".format(idx), None, 8, True)
+            #the in process broker answers at once, main() connects and advertises without waiting
+            while not device.started:
+                device.main()
+            self.advert_times.append(time.monotonic() - begin)
+            self.devices.append(device)
+            sensors = env_sensors.SensorScheduler([env_node], self.sensor_period)
+            #the devices did not boot at the same time
+            env_node.cycle = env_node.due = time.ticks_add(env_node.due, random.randrange(self.sensor_period))
+            self.parts.append((dimmers, sensors))
+        return time.monotonic() - start
+
+    def on_state(self, record):
+        if record.payload == b"ready":
+            self.ready.add(record.topic.split("/")[1])
+
+    def on_value(self, record):
+        pending = self.pending_sets.get(record.topic)
+        if pending and pending[0] == record.payload:
+            del self.pending_sets[record.topic]
+            self.latencies.append(record.time - pending[1])
+
+    async def worker(self, shard):
+        while True:
+            start = time.monotonic()
+            for idx in shard:
+                self.devices[idx].main()
+                self.parts[idx][1].run()
+            await asyncio.sleep(max(MQTT_PERIOD / 1000 - (time.monotonic() - start), 0))
+
+    async def controller(self, broker, rate):
+        """Set commands on random dimmers, rate per second."""
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            idx = random.randrange(self.count)
+            chan = random.choice("abcd")
+            value = str(random.randrange(101))
+            topic = "homie/fleet{:05}/dimmer/chan-{}".format(idx, chan)
+            if topic in self.pending_sets:
+                self.superseded += 1
+            self.pending_sets[topic] = (value.encode(), broker.clock())
+            self.sets += 1
+            broker.publish(topic + "/set", value)
+
+    async def buttons(self, rate):
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            random.choice(self.parts[random.randrange(self.count)][0]).press()
+
+    async def environment(self):
+        """Slow random walk of the measured environment."""
+        while True:
+            await asyncio.sleep(1)
+            hw.env["temperature"] = min(max(hw.env["temperature"] + random.uniform(-0.3, 0.3), 15), 30)
+            hw.env["humidity"] = min(max(hw.env["humidity"] + random.uniform(-1, 1), 20), 80)
+            hw.env["pressure"] += random.uniform(-0.5, 0.5)
+
+    async def run(self, broker, args):
+        workers = [self.worker(range(idx, self.count, args.workers)) for idx in range(args.workers)]
+        tasks = [asyncio.ensure_future(coro) for coro in workers + [self.environment()]]
+        if args.sets:
+            tasks.append(asyncio.ensure_future(self.controller(broker, args.sets)))
+        if args.presses:
+            tasks.append(asyncio.ensure_future(self.buttons(args.presses)))
+        start = broker.clock()
+        counted = len(broker.log)
+        rates = []
+        for _ in range(int(args.seconds)):
+            await asyncio.sleep(1)
+            #the log is only needed for the rate, it would grow without bound
+            rates.append(len(broker.log) - counted)
+            del broker.log[:]
+            counted = 0
+        for task in tasks:
+            task.cancel()
+        return rates, broker.clock() - start
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=100, help="number of simulated controllers")
+    parser.add_argument("--seconds", type=float, default=20, help="duration of the traffic phase")
+    parser.add_argument("--workers", type=int, default=4, help="asyncio workers running the devices")
+    parser.add_argument("--sets", type=float, default=10, help="set commands per second sent by the controller")
+    parser.add_argument("--presses", type=float, default=5, help="button presses per second over the fleet")
+    parser.add_argument("--sensor-period", type=float, default=10, help="seconds between two measures of a device")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random traffic")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    broker = sim.install()
+    hw.i2c_devices.append(0x76)
+    #the advertisement digests are written in the current directory
+    os.chdir(tempfile.mkdtemp(prefix="fleet_"))
+
+    fleet = Fleet(args.devices, int(args.sensor_period * 1000))
+    broker.watch("homie/+/$state", fleet.on_state)
+    broker.watch("homie/+/dimmer/+", fleet.on_value)
+    with Quiet():
+        advert_total = fleet.build(broker)
+        advert_msgs = len(broker.log)
+        del broker.log[:]
+        rates, elapsed = asyncio.run(fleet.run(broker, args))
+
+    adverts = fleet.advert_times
+    print("{} devices advertised in {:.2f} s, {} messages ({:.0f}/s)".format(args.devices, advert_total, advert_msgs,
+                                                                             advert_msgs / advert_total if advert_total else 0))
+    print("advertisement per device: p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms".format(
+        percentile(adverts, 0.5) * 1000, percentile(adverts, 0.95) * 1000, max(adverts) * 1000))
+    print("traffic: {:.0f} messages/s average, {} peak over {:.1f} s".format(sum(rates) / len(rates) if rates else 0,
+                                                                           max(rates) if rates else 0, elapsed))
+    lat = fleet.latencies
+    print("set to echo: {} of {} echoed ({} superseded), p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        len(lat), fleet.sets, fleet.superseded, percentile(lat, 0.5) * 1000, percentile(lat, 0.95) * 1000,
+        percentile(lat, 0.99) * 1000, max(lat) * 1000 if lat else 0))
+    failed = args.devices - len(fleet.ready)
+    if failed:
+        print("{} devices never reached the ready state".format(failed))
+    #a set sent in the last MQTT periods may still be pending
+    lost = len([sent for value, sent in fleet.pending_sets.values() if broker.clock() - sent > 1])
+    if lost:
+        print("{} set commands not echoed".format(lost))
+    return 1 if failed or lost else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""State of the virtual hardware shared by the machine, sensor and network stand-ins.
+
+Scripts drive the inputs (buttons, ADC, sensors) through this module and
+read the outputs (PWM duties) back from it.
+"""
+
+mac = b"\x24\x0a\xc4\x00\x00\x01"
+
+#"esp32" or "esp8266", the stand-ins behave like the port of the board
+platform = "esp32"
+
+#pin id -> last Pin / PWM object created on it
+pins = {}
+pwms = {}
+
+#pin id -> int, list of ints (read in a loop) or callable returning an int
+adc_values = {}
+
+#addresses answering on the I2C bus, roms on the onewire bus
+i2c_devices = []
+onewire_roms = []
+
+#environment seen by the DHT, DS1820 and BME280 stand-ins
+env = {"temperature": 21.5, "humidity": 45.0, "pressure": 1013.25}
+
+#sensor name ("dht", "ds1820", "bme280") -> number of next reads that fail, also
+#"bme280_setup" (driver creation) and "onewire_scan"
+sensor_failures = {}
+
+rtc_memory = bytearray()
+
+#watchdog started by machine.WDT: timeout, feeds, longest time (ms) without a feed and
+#monotonic time of the last feed
+wdt = {}
+
+
+def press(pin_id):
+    """Pulls the (active low) button on pin_id down."""
+    pins[pin_id].drive(0)
+
+
+def release(pin_id):
+    pins[pin_id].drive(1)
+
+
+def duty(pin_id):
+    return pwms[pin_id].duty()
+
+
+def adc_read(pin_id):
+    value = adc_values.get(pin_id, 0)
+    if callable(value):
+        return value()
+    if isinstance(value, list):
+        value.append(value.pop(0))
+        return value[-1]
+    return value
+
+
+def sensor_fails(name):
+    count = sensor_failures.get(name, 0)
+    if count:
+        sensor_failures[name] = count - 1
+    return count > 0
+
+
+def reset():
+    pins.clear()
+    pwms.clear()
+    adc_values.clear()
+    del i2c_devices[:]
+    del onewire_roms[:]
+    sensor_failures.clear()
+    wdt.clear()
@@ -0,0 +1,18 @@
+from sim import hw
+
+
+class BME280:
+    def __init__(self, address=0x76, i2c=None, humidity_capable=True):
+        self.address = address
+        self.i2c = i2c
+        self.humidity_capable = humidity_capable
+        #the driver reads the calibration data
+        if hw.sensor_fails("bme280_setup"):
+            raise OSError(19)
+
+    def read_compensated_data(self):
+        """Same fixed point format as the driver: 1/100 degC, Pa * 256, %RH * 1024."""
+        if hw.sensor_fails("bme280"):
+            raise OSError(19)
+        return (int(hw.env["temperature"] * 100), int(hw.env["pressure"] * 100 * 256),
+                int(hw.env["humidity"] * 1024))
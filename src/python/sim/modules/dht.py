@@ -0,0 +1,27 @@
+from sim import hw
+
+
+class DHTChecksumError(Exception):
+    pass
+
+
+class DHT22:
+    def __init__(self, pin, **kwargs):
+        self.pin = pin
+        self._temperature = None
+        self._humidity = None
+
+    def measure(self):
+        if hw.sensor_fails("dht"):
+            raise OSError(110)
+        self._temperature = round(hw.env["temperature"], 1)
+        self._humidity = round(hw.env["humidity"], 1)
+
+    def temperature(self):
+        return self._temperature
+
+    def humidity(self):
+        return self._humidity
+
+
+DHT11 = DHT22
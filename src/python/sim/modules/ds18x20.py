@@ -0,0 +1,19 @@
+from sim import hw
+
+
+class DS18X20:
+    def __init__(self, onewire):
+        self.ow = onewire
+
+    def scan(self):
+        if hw.sensor_fails("onewire_scan"):
+            raise OSError(110)
+        return list(hw.onewire_roms)
+
+    def convert_temp(self):
+        pass
+
+    def read_temp(self, rom):
+        if hw.sensor_fails("ds1820"):
+            raise OSError(110)
+        return hw.env["temperature"]
@@ -0,0 +1,163 @@
+import time
+
+from sim import hw
+
+
+class Reset(BaseException):
+    """Raised by reset(), the simulation stops like the board would reboot."""
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self.pin_id = pin_id
+        self.mode = mode
+        self.pull = pull
+        self.level = 1 if pull == self.PULL_UP else 0
+        if value is not None:
+            self.level = value
+        self.handler = None
+        self.trigger = 0
+        hw.pins[pin_id] = self
+
+    def __repr__(self):
+        return "Pin({})".format(self.pin_id)
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        self.level = 1 if level else 0
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self.handler = handler
+        self.trigger = trigger
+
+    def drive(self, level):
+        """Level forced from outside the board, fires the irq handler on an edge."""
+        level = 1 if level else 0
+        if level == self.level:
+            return
+        self.level = level
+        edge = self.IRQ_RISING if level else self.IRQ_FALLING
+        if self.handler and self.trigger & edge:
+            self.handler(self)
+
+
+class PWM:
+    def __init__(self, pin, freq=5000, duty=512):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+        #ticks_ms of the last duty change
+        self.changed = time.ticks_ms()
+        hw.pwms[pin.pin_id] = self
+
+    def duty(self, value=None):
+        if value is None:
+            return self._duty
+        value = min(max(int(value), 0), 1023)
+        if value != self._duty:
+            self._duty = value
+            self.changed = time.ticks_ms()
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def deinit(self):
+        hw.pwms.pop(self.pin.pin_id, None)
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+    WIDTH_9BIT = 0
+    WIDTH_10BIT = 1
+    WIDTH_11BIT = 2
+    WIDTH_12BIT = 3
+
+    def __init__(self, pin):
+        self.pin_id = pin.pin_id if isinstance(pin, Pin) else pin
+        self.bits = 10
+
+    def atten(self, attn):
+        self.attn = attn
+
+    def width(self, width):
+        self.bits = width + 9
+
+    def read(self):
+        return min(hw.adc_read(self.pin_id), (1 << self.bits) - 1)
+
+
+class I2C:
+    def __init__(self, bus_id=-1, scl=None, sda=None, freq=400000):
+        self.bus_id = bus_id
+
+    def scan(self):
+        return list(hw.i2c_devices)
+
+
+class RTC:
+    def datetime(self, value=None):
+        tm = time.gmtime()
+        return (tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0)
+
+    def memory(self, data=None):
+        if data is None:
+            return bytes(hw.rtc_memory)
+        hw.rtc_memory[:] = data
+
+
+#the ESP8266 port takes no timeout, its hardware one is fixed (taken short)
+ESP8266_TIMEOUT_MS = 1600
+
+
+class WDT:
+    """Records the feeds, the board would reset after timeout ms without one.
+    The arguments are checked like the port of hw.platform does."""
+
+    def __init__(self, id=0, **kwargs):
+        if hw.platform == "esp8266":
+            if kwargs:
+                raise TypeError("function doesn't take keyword arguments")
+            timeout = ESP8266_TIMEOUT_MS
+        else:
+            timeout = kwargs.pop("timeout", 5000)
+            if kwargs:
+                raise TypeError("unexpected keyword argument")
+        hw.wdt.update(timeout=timeout, feeds=0, longest=0, last=time.monotonic())
+
+    def feed(self):
+        now = time.monotonic()
+        hw.wdt["feeds"] += 1
+        hw.wdt["longest"] = max(hw.wdt["longest"], int((now - hw.wdt["last"]) * 1000))
+        hw.wdt["last"] = now
+
+
+def unique_id():
+    return hw.mac
+
+
+def reset():
+    raise Reset()
+
+
+def freq(value=None):
+    return 160000000
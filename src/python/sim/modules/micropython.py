@@ -0,0 +1,15 @@
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+
+def mem_info(verbose=False):
+    print("mem: not available in simulation")
+
+
+def alloc_emergency_exception_buf(size):
+    pass
@@ -0,0 +1,23 @@
+from sim import hw
+
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+
+    def active(self, state=None):
+        return True
+
+    def isconnected(self):
+        return True
+
+    def config(self, param):
+        if param == "mac":
+            return hw.mac
+        raise ValueError(param)
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
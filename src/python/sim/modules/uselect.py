@@ -0,0 +1,30 @@
+"""poll() on the usocket stand-ins, never waits: the broker answers at once."""
+POLLIN = 0x001
+POLLOUT = 0x004
+POLLERR = 0x008
+POLLHUP = 0x010
+
+
+class poll:
+    def __init__(self):
+        self.registered = {}
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        self.registered[obj] = eventmask
+
+    def unregister(self, obj):
+        self.registered.pop(obj, None)
+
+    def modify(self, obj, eventmask):
+        self.registered[obj] = eventmask
+
+    def poll(self, timeout=-1):
+        events = []
+        for obj, mask in self.registered.items():
+            event = obj.poll_events() & (mask | POLLERR | POLLHUP)
+            if event:
+                events.append((obj, event))
+        return events
+
+    def ipoll(self, timeout=-1, flags=0):
+        return iter(self.poll(timeout))
@@ -0,0 +1,127 @@
+"""Stream sockets connected to the in process broker, whatever the address,
+and datagram sockets answered by an SNTP server giving the host time."""
+import time
+
+from sim import broker as sim_broker
+import uselect
+
+AF_INET = 2
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+EAGAIN = 11
+ECONNRESET = 104
+ETIMEDOUT = 110
+NTP_DELTA = 2208988800
+EINPROGRESS = 115
+
+#seconds a blocking read waits for data injected by another thread
+BLOCKING_WAIT = 1
+
+
+def getaddrinfo(host, port, af=0, socktype=0, proto=0, flags=0):
+    return [(AF_INET, SOCK_STREAM, 0, "", (host, port))]
+
+
+class socket:
+    def __init__(self, af=AF_INET, socktype=SOCK_STREAM, proto=0):
+        self.broker = sim_broker.BROKER
+        self.conn = None
+        self.rx = bytearray()
+        self.blocking = True
+        self.eof = False
+        self.error = 0
+        self.datagram = socktype == SOCK_DGRAM
+
+    def connect(self, addr):
+        """A non blocking connect raises EINPROGRESS, poll() then reports the outcome."""
+        try:
+            self.conn = self.broker.accept(self)
+        except OSError as excp:
+            if self.blocking:
+                raise
+            self.error = excp.args[0]
+        if not self.blocking:
+            raise OSError(EINPROGRESS)
+
+    def poll_events(self):
+        if self.error:
+            return uselect.POLLERR | uselect.POLLHUP
+        events = uselect.POLLOUT if self.conn and self.conn.open else 0
+        if self.rx:
+            events |= uselect.POLLIN
+        if self.eof:
+            events |= uselect.POLLHUP
+        return events
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def settimeout(self, value):
+        self.blocking = value != 0
+
+    #broker side
+
+    def feed(self, data):
+        self.rx += data
+
+    def hangup(self):
+        self.eof = True
+
+    #client side
+
+    def write(self, buf, length=None):
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8")
+        data = bytes(buf if length is None else buf[:length])
+        with self.broker.lock:
+            if self.conn is None or not self.conn.open:
+                raise OSError(self.error or ECONNRESET)
+            self.conn.receive(data)
+        return len(data)
+
+    send = write
+
+    def sendto(self, buf, addr):
+        #the SNTP answer: the request is received and answered at once
+        now = time.time()
+        answer = bytearray(48)
+        answer[0] = 0x1C
+        for pos in (32, 40):
+            answer[pos:pos + 4] = (int(now) + NTP_DELTA).to_bytes(4, "big")
+            answer[pos + 4:pos + 8] = int(now % 1 * (1 << 32)).to_bytes(4, "big")
+        self.rx = answer
+        return len(buf)
+
+    def read(self, size):
+        if self.datagram:
+            if not self.rx:
+                raise OSError(EAGAIN)
+            data, self.rx = bytes(self.rx), bytearray()
+            return data
+        if not size:
+            #empty payload, returned at once like the port
+            return b""
+        with self.broker.lock:
+            if len(self.rx) < size and self.blocking and not self.eof:
+                self.broker.data.wait(BLOCKING_WAIT)
+            if not self.rx:
+                if self.eof:
+                    return b""
+                if not self.blocking:
+                    return None
+                raise OSError(ETIMEDOUT)
+            data = bytes(self.rx[:size])
+            del self.rx[:size]
+            return data
+
+    recv = read
+
+    def close(self):
+        if self.datagram:
+            return
+        with self.broker.lock:
+            if self.conn:
+                self.conn.close(False)
+                if self.conn in self.broker.connections:
+                    self.broker.connections.remove(self.conn)
+            self.eof = True
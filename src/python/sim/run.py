@@ -0,0 +1,145 @@
+"""Runs main.py unmodified against the virtual hardware and the in process broker.
+
+Run from src/python, for instance:
+
+    python -m sim.run --seconds 20 --config '{"dht": true}' --press 32@2+0.2 \
+        --set dimmer/chan-b=40@5 --outage 8+5 --silence 14+4 --log publications.jsonl \
+        --config '{"groups": ["house"]}' --broadcast house/scene/levels=0,0,0,0@9+0.5
+
+Times are seconds after start. The board files (config.json,
+log.txt, crash.txt...) are written in --workdir (a temporary directory by
+default). The simulation is stopped with a KeyboardInterrupt like on the
+serial console.
+"""
+import argparse
+import json
+import os
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import _thread
+import binascii
+
+import sim
+from sim import hw
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(SRC_DIR, "main.py")
+
+SIM_CONFIG = {
+    "esp32": True,
+    "broker": "127.0.0.1",
+    "location": " - simulation",
+}
+
+
+def at(delay, func, *args):
+    timer = threading.Timer(delay, func, args)
+    timer.daemon = True
+    timer.start()
+
+
+def publish_broadcast(broker, topic, value, delay):
+    if delay:
+        value = "{}@{:.3f}".format(value, time.time() + delay)
+    broker.publish(topic, value)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10, help="duration of the simulation")
+    parser.add_argument("--config", default="{}", help="json object merged in the simulated config.json")
+    parser.add_argument("--press", action="append", default=[], metavar="PIN@START+DURATION",
+                        help="press the button on PIN")
+    parser.add_argument("--set", action="append", default=[], metavar="NODE/PROP=VALUE@TIME",
+                        help="publish VALUE on the set topic of the property")
+    parser.add_argument("--broadcast", action="append", default=[], metavar="GROUP/NODE/PROP=VALUE@TIME[+DELAY]",
+                        help="broadcast VALUE to the GROUP, to be run DELAY seconds after its publication")
+    parser.add_argument("--adc", action="append", default=[], metavar="PIN=V1,V2,...",
+                        help="raw values read in a loop on the ADC PIN")
+    parser.add_argument("--outage", action="append", default=[], metavar="START+DURATION",
+                        help="stop the broker")
+    parser.add_argument("--silence", action="append", default=[], metavar="START+DURATION",
+                        help="cut the network without closing the connections (half open)")
+    parser.add_argument("--log", help="write every publication as json lines in this file")
+    parser.add_argument("--workdir", help="directory used as the board file system")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log_path = args.log and os.path.abspath(args.log)
+    sys.path.insert(0, SRC_DIR)
+    broker = sim.install()
+
+    config = dict(SIM_CONFIG)
+    config.update(json.loads(args.config))
+    hw.platform = "esp32" if config["esp32"] else "esp8266"
+    if config.get("bme280"):
+        hw.i2c_devices.append(0x76)
+    if config.get("ds1820"):
+        hw.onewire_roms.append(bytearray(b"\x28\x00\x00\x00\x00\x00\x00\x01"))
+    for adc in args.adc:
+        pin, values = adc.split("=")
+        hw.adc_values[int(pin)] = [int(value) for value in values.split(",")]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="multicontroler_")
+    os.chdir(workdir)
+    with open("config.json", "w") as cfg_file:
+        json.dump(config, cfg_file)
+
+    device_id = binascii.hexlify(hw.mac).decode()
+    for press in args.press:
+        pin, timing = press.split("@")
+        start, duration = (float(value) for value in timing.split("+"))
+        at(start, hw.press, int(pin))
+        at(start + duration, hw.release, int(pin))
+    for set_cmd in args.set:
+        prop, value = set_cmd.split("=")
+        value, when = value.rsplit("@", 1)
+        at(float(when), broker.publish, "homie/{}/{}/set".format(device_id, prop), value)
+    for broadcast in args.broadcast:
+        path, value = broadcast.split("=")
+        value, timing = value.rsplit("@", 1)
+        when, _, delay = timing.partition("+")
+        at(float(when), publish_broadcast, broker, "homie/$broadcast/" + path, value, delay and float(delay))
+    for outage in args.outage:
+        start, duration = (float(value) for value in outage.split("+"))
+        at(start, broker.stop)
+        at(start + duration, broker.start)
+    for silence in args.silence:
+        start, duration = (float(value) for value in silence.split("+"))
+        at(start, broker.silence)
+        at(start + duration, broker.start)
+    at(args.seconds, _thread.interrupt_main)
+
+    start = broker.clock()
+    try:
+        runpy.run_path(MAIN, run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+
+    print("{} publications in {:.1f} s, workdir {}".format(len(broker.log), broker.clock() - start, workdir))
+    expired = False
+    if hw.wdt:
+        #a watchdog starved at the end counts too
+        hw.wdt["longest"] = max(hw.wdt["longest"], int((time.monotonic() - hw.wdt["last"]) * 1000))
+        print("watchdog: {feeds} feeds, at most {longest} ms apart, timeout {timeout} ms".format(**hw.wdt))
+        expired = hw.wdt["longest"] > hw.wdt["timeout"]
+        if expired:
+            print("WATCHDOG expired, the board would have reset")
+    for pin_id, pwm in sorted(hw.pwms.items()):
+        print("pwm {}: duty {}".format(pin_id, pwm.duty()))
+    if log_path:
+        with open(log_path, "w") as log_file:
+            for record in broker.log:
+                record = record.to_dict()
+                record["time"] -= start
+                log_file.write(json.dumps(record) + "\n")
+    return 1 if expired else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import time
+import ustruct
+from machine import RTC
+from micropython import const
+
+import eventlog
+
+MAGIC = const(0x4C53)
+#magic, cycler mode, channel count then the channel levels, followed by a checksum
+HEADER = "<HBB"
+STATE_FILE = "state.bin"
+
+
+class Snapshot:
+    """Keeps the channel levels and the cycler mode across resets.
+
+    periodic() packs the state, when it changed it is written at once in
+    the RTC memory (kept over resets and watchdog resets, lost when
+    unpowered). The flash copy is only written flash_ms after the previous
+    one, so a burst of changes makes a single flash write of its last
+    state; 0 disables it.
+
+    restore() applies the state found in the RTC memory, or on flash, to the
+    channels before the network is set up.
+    """
+
+    def __init__(self, dimmers, color_manager, flash_ms=60000):
+        self.dimmers = dimmers
+        self.color_manager = color_manager
+        self.flash_ms = flash_ms
+        self.format = HEADER + "H" * len(dimmers)
+        self.size = ustruct.calcsize(self.format)
+        self.state = bytearray(self.size + 2)
+        self.saved = bytearray(self.size + 2)
+        self.dirty = False
+        self.flashed_at = time.ticks_ms()
+        self.rtc = RTC()
+
+    def pack(self, buf):
+        ustruct.pack_into(self.format, buf, 0, MAGIC, self.color_manager.cycle, len(self.dimmers),
+                          *[dimmer.channel.target for dimmer in self.dimmers])
+        ustruct.pack_into("<H", buf, self.size, sum(buf[:self.size]) & 0xFFFF)
+
+    def unpack(self, data):
+        """(levels, cycler mode) of a valid state, None otherwise."""
+        if not data or len(data) != self.size + 2:
+            return None
+        if ustruct.unpack_from("<H", data, self.size)[0] != sum(data[:self.size]) & 0xFFFF:
+            return None
+        values = ustruct.unpack_from(self.format, data)
+        if values[0] != MAGIC or values[2] != len(self.dimmers):
+            return None
+        return values[3:], values[1]
+
+    def periodic(self):
+        self.pack(self.state)
+        if self.state != self.saved:
+            self.rtc.memory(self.state)
+            self.saved[:] = self.state
+            self.dirty = True
+        if self.dirty and self.flash_ms and time.ticks_diff(time.ticks_ms(), self.flashed_at) >= self.flash_ms:
+            self.flashed_at = time.ticks_ms()
+            self.dirty = False
+            try:
+                with open(STATE_FILE, "wb") as state_file:
+                    state_file.write(self.saved)
+            except OSError as excp:
+                eventlog.error("state write error {}", excp)
+
+    def restore(self):
+        """Applies the last saved state, returns where it was found (None if nowhere)."""
+        source = "rtc"
+        data = self.rtc.memory()
+        state = self.unpack(data)
+        if not state:
+            source = "flash"
+            try:
+                with open(STATE_FILE, "rb") as state_file:
+                    state = self.unpack(state_file.read())
+            except OSError:
+                pass
+        if not state:
+            return None
+        levels, cycle = state
+        for dimmer, level in zip(self.dimmers, levels):
+            dimmer.channel.set(level)
+            if level:
+                dimmer.last_value = level
+            #advertised as the initial values
+            dimmer.send_value(dimmer.percent())
+        color_manager = self.color_manager
+        color_manager.props[0].send_value(color_manager.color())
+        if cycle and color_manager.set_cycler(None, cycle):
+            color_manager.props[1].send_value(str(cycle))
+        if source == "rtc":
+            self.saved[:] = data
+        return source
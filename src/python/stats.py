@@ -0,0 +1,74 @@
+import gc
+from array import array
+
+import homie
+
+#upper bounds (ms) of the lateness histogram buckets, the last bucket takes the rest
+JITTER_LIMITS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class LoopStats:
+    """Fixed size counters filled by the scheduler for every job (stage).
+
+    For each stage the calls, total and maximum duration (us) are kept, the
+    lateness of every wake up compared to the job deadline feeds a single
+    histogram. reset() starts a new period.
+    """
+
+    def __init__(self, names):
+        self.names = names
+        self.calls = array("i", [0] * len(names))
+        self.total_us = array("i", [0] * len(names))
+        self.max_us = array("i", [0] * len(names))
+        self.jitter = array("i", [0] * (len(JITTER_LIMITS) + 1))
+
+    def record(self, idx, late_ms, duration_us):
+        self.calls[idx] += 1
+        self.total_us[idx] += duration_us
+        if duration_us > self.max_us[idx]:
+            self.max_us[idx] = duration_us
+        bucket = 0
+        for limit in JITTER_LIMITS:
+            if late_ms < limit:
+                break
+            bucket += 1
+        self.jitter[bucket] += 1
+
+    def reset(self):
+        for counters in (self.calls, self.total_us, self.max_us, self.jitter):
+            for idx in range(len(counters)):
+                counters[idx] = 0
+
+
+class Diagnostics(homie.Node):
+    """Publishes the loop statistics, free heap and MQTT counters every period.
+
+    The largest free block is not published: MicroPython only prints it
+    (micropython.mem_info), probing it with allocations would fragment the
+    heap it is meant to watch.
+    """
+
+    def __init__(self, loop_stats):
+        self.loop_stats = loop_stats
+        props = [homie.Property("heap-free", "Free heap", "integer", "B", None, 0),
+                 homie.Property("publishes", "Publications", "integer", None, None, 0),
+                 homie.Property("reconnects", "MQTT reconnections", "integer", None, None, 0),
+                 homie.Property("jitter", "Wake up lateness histogram", "string", None, None, ""),
+                 homie.Property("stages", "Stage calls/avg us/max us", "string", None, None, "")]
+        super().__init__("diagnostics", "Diagnostics", props)
+
+    def periodic(self):
+        stats = self.loop_stats
+        props = self.properties
+        if props[-1].meta:
+            #not advertised yet
+            return
+        homie_dev = props[0].homie
+        props[0].send_value(gc.mem_free())
+        props[1].send_value(homie_dev.publish_count)
+        props[2].send_value(homie_dev.reconnects)
+        props[3].send_value(",".join(["<{}:{}".format(limit, count) for limit, count in zip(JITTER_LIMITS, stats.jitter)]
+                                     + [">{}:{}".format(JITTER_LIMITS[-1], stats.jitter[-1])]))
+        props[4].send_value(",".join(["{}:{}/{}/{}".format(name, calls, total // calls if calls else 0, worst)
+                                      for name, calls, total, worst in zip(stats.names, stats.calls, stats.total_us, stats.max_us)]))
+        stats.reset()
@@ -0,0 +1,64 @@
+"""pytest setup: the modules of src/python run on CPython through the sim
+stand-ins (see sim.install), time.ticks_ms is driven by the tests.
+
+test_homie.py and test_hw.py are scripts run on a board, they are not
+collected.
+"""
+import os
+import sys
+import time
+
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+
+import sim
+
+sim.install()
+
+from sim import broker as sim_broker
+
+collect_ignore = ["test_homie.py", "test_hw.py"]
+
+
+class Clock:
+    """ticks_ms and time() moved forward by the test only."""
+
+    def __init__(self):
+        self.ms = 1000
+        self.seconds = 100000
+
+    def ticks_ms(self):
+        return self.ms
+
+    def time(self):
+        return self.seconds
+
+    def advance(self, ms):
+        self.ms += ms
+        self.seconds += ms // 1000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(time, "ticks_ms", fake.ticks_ms)
+    monkeypatch.setattr(time, "time", fake.time)
+    return fake
+
+
+@pytest.fixture
+def broker(tmp_path, monkeypatch):
+    """A new in process broker, the device files go to a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    fresh = sim_broker.Broker()
+    monkeypatch.setattr(sim_broker, "BROKER", fresh)
+    return fresh
+
+
+def start(device):
+    """Connects the device and runs it until its advertisement is acknowledged."""
+    while not device.started:
+        device.main()
+    return device
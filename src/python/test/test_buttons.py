@@ -0,0 +1,67 @@
+from sim import hw
+
+import buttons
+
+PIN = 0
+
+
+def bounce(clock, level, edges=3):
+    """Drives the pin to level with bounces 2 ms apart."""
+    for _ in range(edges):
+        hw.pins[PIN].drive(level)
+        clock.advance(2)
+        hw.pins[PIN].drive(1 - level)
+        clock.advance(2)
+    hw.pins[PIN].drive(level)
+
+
+def test_bouncing_press_gives_one_press(clock):
+    button = buttons.Button(PIN)
+    pressed_at = clock.ms
+    bounce(clock, 0)
+    #still bouncing
+    assert button.poll() == 0
+    clock.advance(buttons.DEBOUNCE_MS)
+    assert button.poll() == buttons.PRESS
+    assert button.press_time == pressed_at
+    assert button.poll() == 0
+    bounce(clock, 1)
+    clock.advance(buttons.DEBOUNCE_MS)
+    assert button.poll() == buttons.RELEASE
+    assert button.poll() == 0
+
+
+def test_glitch_is_ignored(clock):
+    button = buttons.Button(PIN)
+    hw.press(PIN)
+    clock.advance(5)
+    hw.release(PIN)
+    clock.advance(buttons.DEBOUNCE_MS)
+    assert button.poll() == 0
+    assert not button.pressed
+
+
+def test_long_press(clock):
+    button = buttons.Button(PIN)
+    hw.press(PIN)
+    clock.advance(buttons.DEBOUNCE_MS)
+    assert button.poll() == buttons.PRESS
+    clock.advance(buttons.LONG_PRESS_MS - buttons.DEBOUNCE_MS)
+    assert button.poll() == buttons.LONG_PRESS
+    clock.advance(1000)
+    assert button.poll() == 0
+    hw.release(PIN)
+    clock.advance(buttons.DEBOUNCE_MS)
+    assert button.poll() == buttons.RELEASE
+    assert button.long
+
+
+def test_events_do_not_depend_on_poll_delay(clock):
+    button = buttons.Button(PIN)
+    hw.press(PIN)
+    clock.advance(100)
+    hw.release(PIN)
+    clock.advance(2000)
+    assert button.poll() == buttons.PRESS
+    assert button.poll() == buttons.RELEASE
+    assert not button.long
@@ -0,0 +1,229 @@
+import pytest
+
+import homie
+import mqtt_link
+import robust
+from conftest import start
+
+
+class Channel:
+    """Settable property converting its value like the dimmers."""
+
+    def __init__(self):
+        self.levels = []
+
+    def set(self, topic_split, value):
+        self.levels.append(int(float(value)))
+        return True
+
+
+def make_device(props, device_id=b"test", name="Test", **kwargs):
+    mqtt = robust.MQTTClient(device_id, "127.0.0.1", keepalive=4*homie.KEEP_ALIVE)
+    return homie.HomieDevice(mqtt, device_id, [homie.Node("dimmer", "Dimmers", props)], name, **kwargs)
+
+
+@pytest.mark.parametrize("payload", [b"abc", b"", b"inf", b"-inf", b"nan", b"1e400"])
+def test_malformed_set_is_dropped(broker, payload):
+    channel = Channel()
+    device = start(make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)]))
+    broker.publish("homie/test/dimmer/chan-a/set", payload)
+    device.main()
+    assert channel.levels == []
+    assert not broker.records("homie/test/dimmer/chan-a")[1:]
+    broker.publish("homie/test/dimmer/chan-a/set", b"40")
+    device.main()
+    device.main()
+    assert channel.levels == [40]
+    assert broker.records("homie/test/dimmer/chan-a")[-1].payload == b"40"
+
+
+def test_set_property_refuses_malformed_content(broker):
+    channel = Channel()
+    device = start(make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)]))
+    assert not device.set_property(b"dimmer/chan-a", b"inf")
+    assert not device.set_property(b"dimmer/chan-b", b"1")
+    assert device.set_property(b"dimmer/chan-a", b"12.5")
+    assert channel.levels == [12]
+
+
+def reconnect(device, broker, clock):
+    """Broker restarted, the device reconnects keeping its session."""
+    broker.stop()
+    broker.start()
+    device.main()
+    assert not device.online
+    clock.advance(mqtt_link.BACKOFF_MAX_MS)
+    for _ in range(10):
+        device.main()
+    assert device.online
+
+
+def test_lost_subscribe_is_sent_again(broker, clock, monkeypatch):
+    channel = Channel()
+    on_subscribe = broker.on_subscribe
+    lost = []
+
+    def lose_first(conn, body):
+        if not lost:
+            lost.append(body)
+        else:
+            on_subscribe(conn, body)
+
+    monkeypatch.setattr(broker, "on_subscribe", lose_first)
+    device = make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)])
+    start(device)
+    assert lost
+    assert list(device.window.subscribing.values()) == ["homie/test/+/+/set"]
+    reconnect(device, broker, clock)
+    broker.publish("homie/test/dimmer/chan-a/set", b"30")
+    device.main()
+    assert channel.levels == [30]
+    assert not device.window.subscribing
+
+
+def test_acknowledged_subscriptions_are_kept_by_the_session(broker, clock):
+    channel = Channel()
+    device = start(make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)]))
+    broker.publish("homie/test/dimmer/chan-a/set", b"30", retain=True)
+    device.main()
+    assert channel.levels == [30]
+    reconnect(device, broker, clock)
+    device.main()
+    #subscribing again would have the retained command delivered again
+    assert channel.levels == [30]
+    broker.publish("homie/test/dimmer/chan-a/set", b"40")
+    device.main()
+    assert channel.levels == [30, 40]
+
+
+def test_subscriptions_are_restored_on_a_new_session(broker, clock):
+    channel = Channel()
+    device = start(make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)]))
+    #the broker restarted without its sessions
+    broker.unindex(broker.sessions.pop("test"))
+    reconnect(device, broker, clock)
+    broker.publish("homie/test/dimmer/chan-a/set", b"40")
+    device.main()
+    assert channel.levels == [40]
+
+
+def test_messages_are_routed_by_topic(broker):
+    channel = Channel()
+    broadcasts = []
+    others = []
+    device = make_device([homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)],
+                         broadcast_cb=lambda topic, content, retain: broadcasts.append((topic, content)))
+    device.set_user_cb(lambda topic, content: others.append((topic, content)))
+    start(device)
+    device.subscribe("homie/other")
+    device.main()
+    broker.publish("homie/test/dimmer/chan-a/set", b"20")
+    broker.publish("homie/$broadcast/all/dimmer/levels", b"50")
+    broker.publish("homie/other", b"x")
+    #set topic of no property
+    broker.publish("homie/test/dimmer/chan-z/set", b"10")
+    device.main()
+    assert channel.levels == [20]
+    assert broadcasts == [(b"homie/$broadcast/all/dimmer/levels", b"50")]
+    assert others == [(b"homie/other", b"x"), (b"homie/test/dimmer/chan-z/set", b"10")]
+
+
+def advertised(broker, **kwargs):
+    """Advertises a new device, returns the publications of its $name attributes."""
+    start(make_device([homie.Property("chan-a", "A", "integer", None, None, 0)], **kwargs))
+    return broker.records("homie/test/+/$name") + broker.records("homie/test/$name")
+
+
+def test_unchanged_advertisement_is_not_published_again(broker):
+    assert len(advertised(broker)) == 2
+    assert len(advertised(broker)) == 2
+    #the values are published at each boot
+    assert len(broker.records("homie/test/dimmer/chan-a")) == 2
+    assert len(advertised(broker, force_advert=True)) == 4
+
+
+def test_changed_advertisement_is_published(broker):
+    advertised(broker)
+    advertised(broker, name="Renamed")
+    assert [rec.payload for rec in broker.records("homie/test/$name")] == [b"Test", b"Renamed"]
+
+
+def test_digest_is_stored_once_the_advertisement_is_complete(broker):
+    device = make_device([homie.Property("chan-a", "A", "integer", None, None, 0)])
+    while not device.online:
+        device.main()
+    assert not device.started
+    assert homie.HomieDevice.stored_digest() is None
+    start(device)
+    assert homie.HomieDevice.stored_digest() == device.advert_digest
+
+
+def test_burst_is_coalesced_to_its_last_value(broker, clock):
+    prop = homie.Property("chan-a", "A", "integer", None, None, 0, min_interval=250)
+    device = start(make_device([prop]))
+    clock.advance(250)
+    for value in ("1", "2", "3"):
+        prop.send_value(value)
+        device.main()
+    clock.advance(100)
+    device.main()
+    assert [rec.payload for rec in broker.records("homie/test/dimmer/chan-a")] == [b"0", b"1"]
+    clock.advance(150)
+    device.main()
+    device.main()
+    assert [rec.payload for rec in broker.records("homie/test/dimmer/chan-a")] == [b"0", b"1", b"3"]
+    assert not device.pending_values
+
+
+def test_deferred_value_is_published_by_main(broker):
+    channel = Channel()
+    prop = homie.Property("chan-a", "A", "integer", None, None, 0, channel.set)
+    device = start(make_device([prop]))
+    prop.send_value("10", True)
+    prop.send_value("20", True)
+    assert device.pending_values == {prop: "20"}
+    device.main()
+    device.main()
+    assert [rec.payload for rec in broker.records("homie/test/dimmer/chan-a")] == [b"0", b"20"]
+
+
+def reported(broker, prop, clock, values, step_ms=1000):
+    """Reports values step_ms apart, returns the payloads published."""
+    for value in values:
+        clock.advance(step_ms)
+        prop.report(value)
+        prop.homie.main()
+    return [rec.payload for rec in broker.records("homie/test/dimmer/temperature")][1:]
+
+
+def measure(**policy):
+    prop = homie.Property("temperature", "Temperature", "float", "°C".encode("utf-8"), None, 0, decimals=1)
+    prop.set_report(**policy)
+    return prop
+
+
+def test_report_deadband(broker, clock):
+    prop = measure(deadband=0.5)
+    start(make_device([prop]))
+    assert reported(broker, prop, clock, [200, 204, 205, 201, 210]) == [b"20.0", b"20.5", b"21.0"]
+
+
+def test_report_relative(broker, clock):
+    prop = measure(relative=10)
+    start(make_device([prop]))
+    assert reported(broker, prop, clock, [200, 219, 220, 240, 260]) == [b"20.0", b"22.0", b"26.0"]
+
+
+def test_report_max_interval(broker, clock):
+    prop = measure(deadband=1, max_interval=60)
+    start(make_device([prop]))
+    assert reported(broker, prop, clock, [200, 201, 202], 30000) == [b"20.0", b"20.2"]
+
+
+def test_report_min_interval(broker, clock):
+    prop = measure(min_interval=10)
+    start(make_device([prop]))
+    assert reported(broker, prop, clock, [200], 10000) == [b"20.0"]
+    #the last value of the burst is published 10 s after the previous one
+    assert reported(broker, prop, clock, [210, 220]) == [b"20.0"]
+    assert reported(broker, prop, clock, [230], 10000) == [b"20.0", b"23.0"]
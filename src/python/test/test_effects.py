@@ -0,0 +1,76 @@
+import pytest
+
+import effects
+
+
+class Pwm:
+    def __init__(self, duty=0):
+        self.value = duty
+
+    def duty(self, value=None):
+        if value is None:
+            return self.value
+        self.value = value
+
+
+def duties(engine, frames):
+    """Duties of the channels after each frame."""
+    result = []
+    for _ in range(frames):
+        engine.frame()
+        result.append([pwm.value for pwm in engine.pwms])
+    return result
+
+
+@pytest.mark.parametrize("value", [-1, 0, 30, 45])
+def test_invalid_cycler_value_is_refused(value):
+    assert not effects.Effects([Pwm(), Pwm(), Pwm()]).select(value)
+
+
+def test_cycle_channels_at_their_own_pace():
+    engine = effects.Effects([Pwm(), Pwm(), Pwm()])
+    assert engine.select(1)
+    frames = duties(engine, 400)
+    #each cosine starts at its minimum
+    assert frames[0] == [0, 0, 0]
+    for chan in range(3):
+        values = [frame[chan] for frame in frames]
+        assert min(values) == 0 and max(values) >= 1020
+    assert len({tuple(frame) for frame in frames[1:]}) > 100
+
+
+def test_speed_shortens_the_period():
+    slow = effects.Effects([Pwm()])
+    fast = effects.Effects([Pwm()])
+    slow.select(1)
+    fast.select(4)
+    assert fast.steps[0] // 4 == slow.steps[0]
+
+
+def test_rainbow_channels_are_a_third_apart():
+    engine = effects.Effects([Pwm(), Pwm(), Pwm()])
+    assert engine.select(15)
+    assert len(set(engine.steps)) == 1
+    frames = duties(engine, 300)
+    #the cosine is symmetric, the two other channels start at about the same duty
+    assert abs(frames[0][1] - frames[0][2]) < 40 and frames[0][0] == 0
+    #a third of a period later the first channel has the duty the second one started at
+    third = 0x10000 // 3 // engine.steps[0]
+    assert abs(frames[third][0] - frames[0][1]) < 40
+
+
+def test_breathe_keeps_the_color():
+    engine = effects.Effects([Pwm(800), Pwm(0), Pwm(400)])
+    assert engine.select(21)
+    for red, green, blue in duties(engine, 300):
+        assert green == 0
+        assert abs(red - 2 * blue) <= 1
+        assert red <= 800
+
+
+def test_breathe_from_black_is_white():
+    engine = effects.Effects([Pwm(), Pwm(), Pwm()])
+    engine.select(25)
+    frames = duties(engine, 300)
+    assert all(frame[0] == frame[1] == frame[2] for frame in frames)
+    assert max(frame[0] for frame in frames) >= 1020
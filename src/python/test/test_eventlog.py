@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import eventlog
+
+
+@pytest.fixture(autouse=True)
+def log(tmp_path, monkeypatch, clock):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(eventlog, "level", eventlog.INFO)
+    monkeypatch.setattr(eventlog, "flash_level", eventlog.WARNING)
+    monkeypatch.setattr(eventlog, "ring", [None] * eventlog.RING_SIZE)
+    monkeypatch.setattr(eventlog, "ring_pos", 0)
+    monkeypatch.setattr(eventlog, "unsaved", [])
+    monkeypatch.setattr(eventlog, "saved_at", clock.ms)
+
+
+def flash_records():
+    with open(eventlog.LOG_FILE) as log_file:
+        return log_file.read().splitlines()
+
+
+def test_levels():
+    eventlog.debug("hidden")
+    eventlog.info("shown {}", 1)
+    eventlog.warning("saved {}", 2)
+    assert [text.split(" ", 1)[1] for text in eventlog.records()] == ["I shown 1", "W saved 2"]
+    assert [text.split(" ", 1)[1] for text in eventlog.unsaved] == ["W saved 2"]
+
+
+def test_ring_keeps_the_last_records():
+    for idx in range(eventlog.RING_SIZE + 5):
+        eventlog.info("record {}", idx)
+    records = eventlog.records()
+    assert len(records) == eventlog.RING_SIZE
+    assert records[0].endswith("record 5") and records[-1].endswith("record 36")
+
+
+def test_flash_log_is_written_by_batches(clock):
+    for idx in range(eventlog.FLUSH_COUNT - 1):
+        eventlog.error("error {}", idx)
+    assert not os.path.exists(eventlog.LOG_FILE)
+    eventlog.error("error {}", eventlog.FLUSH_COUNT - 1)
+    assert len(flash_records()) == eventlog.FLUSH_COUNT
+    eventlog.warning("late")
+    clock.advance(eventlog.FLUSH_MS - 1)
+    eventlog.periodic()
+    assert len(flash_records()) == eventlog.FLUSH_COUNT
+    clock.advance(1)
+    eventlog.periodic()
+    assert flash_records()[-1].endswith("W late")
+
+
+def test_full_log_is_rotated():
+    with open(eventlog.LOG_FILE, "w") as log_file:
+        log_file.write("x" * eventlog.LOG_MAX)
+    with open(eventlog.OLD_LOG_FILE, "w") as log_file:
+        log_file.write("older")
+    eventlog.warning("new")
+    eventlog.flush()
+    assert os.path.getsize(eventlog.OLD_LOG_FILE) == eventlog.LOG_MAX
+    assert len(flash_records()) == 1
+
+
+def test_crash_is_stored():
+    assert eventlog.last_crash() is None
+    try:
+        raise ValueError("x" * 3000)
+    except ValueError as excp:
+        eventlog.crash(excp)
+    crash = eventlog.last_crash()
+    stamp, trace = crash.split("\n", 1)
+    assert int(stamp) == 100000 + eventlog.EPOCH_OFFSET
+    assert len(trace) == eventlog.CRASH_MAX
+    assert trace.rstrip().endswith("x")
+    assert "E crash ValueError" in flash_records()[-1]
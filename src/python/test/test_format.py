@@ -0,0 +1,23 @@
+import homie
+
+
+def fixed(value, decimals):
+    buf = bytearray(24)
+    return bytes(buf[:homie.format_fixed(buf, value, decimals)])
+
+
+def test_format_fixed():
+    assert fixed(215, 1) == b"21.5"
+    assert fixed(-5, 2) == b"-0.05"
+    assert fixed(7, 3) == b"0.007"
+    assert fixed(0, 0) == b"0"
+    assert fixed(123456, 0) == b"123456"
+    assert fixed(101325, 2) == b"1013.25"
+
+
+def test_format_fixed_from_pos():
+    buf = bytearray(24)
+    end = homie.format_fixed(buf, 1700000000, 0)
+    buf[end] = 44
+    end = homie.format_fixed(buf, -215, 1, end + 1)
+    assert bytes(buf[:end]) == b"1700000000,-21.5"
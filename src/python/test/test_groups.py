@@ -0,0 +1,121 @@
+import pytest
+
+import eventlog
+import groups
+from clock import Clock
+
+PREFIX = "homie/$broadcast/house/"
+#Unix time of the synchronisation
+SYNC_MS = 1760000000000
+
+
+class Device:
+    def __init__(self):
+        self.sets = []
+
+    def set_property(self, path, payload):
+        self.sets.append((path, payload))
+        return True
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def house(clock):
+    ntp_clock = Clock("pool.ntp.org")
+    ntp_clock.synced = True
+    ntp_clock.unix_ms = SYNC_MS
+    ntp_clock.ticks = clock.ms
+    house = groups.Groups(["house"], ntp_clock)
+    house.device = Device()
+    return house
+
+
+def broadcast(house, content, path="scene/recall", retained=False):
+    house.on_broadcast((PREFIX + path).encode(), content, retained)
+
+
+def stamp(unix_ms):
+    return "{}.{:03}".format(unix_ms // 1000, unix_ms % 1000).encode()
+
+
+def test_parse_time():
+    assert groups.parse_time(b"1760000000") == 1760000000000
+    assert groups.parse_time(b"1760000000.5") == 1760000000500
+    assert groups.parse_time(b"1760000000.1234") == 1760000000123
+    with pytest.raises(ValueError):
+        groups.parse_time(b"soon")
+
+
+def test_untimed_command_runs_at_once(house):
+    broadcast(house, b"2")
+    assert house.device.sets == [(b"scene/recall", b"2")]
+
+
+def test_other_group_and_retained_are_ignored(house):
+    house.on_broadcast(b"homie/$broadcast/garden/scene/recall", b"2", False)
+    broadcast(house, b"2", retained=True)
+    assert not house.device.sets
+
+
+def test_timed_command_runs_in_its_frame(house, clock):
+    broadcast(house, b"50,,0,100@" + stamp(SYNC_MS + 1000))
+    assert house.pending
+    clock.advance(980)
+    house.run()
+    assert not house.device.sets
+    clock.advance(20)
+    house.run()
+    assert house.device.sets == [(b"scene/recall", b"50,,0,100")]
+    assert not house.pending
+
+
+def test_delay_counts_the_time_since_the_synchronisation(house, clock):
+    clock.advance(5000)
+    broadcast(house, b"1@" + stamp(SYNC_MS + 5500))
+    clock.advance(499)
+    house.run()
+    assert not house.device.sets
+    clock.advance(1)
+    house.run()
+    assert house.device.sets
+
+
+def test_late_command_runs_at_once(house):
+    broadcast(house, b"1@" + stamp(SYNC_MS - 2000))
+    assert house.device.sets == [(b"scene/recall", b"1")]
+
+
+@pytest.mark.parametrize("unix_ms", [
+    SYNC_MS + groups.MAX_DELAY_MS + 1,
+    SYNC_MS - groups.MAX_DELAY_MS - 1,
+    #stamp in ms instead of seconds, out of the ticks_ms range
+    SYNC_MS * 1000,
+    0,
+])
+def test_out_of_range_time_is_refused(house, unix_ms):
+    broadcast(house, b"1@" + stamp(unix_ms))
+    assert not house.device.sets
+    assert not house.pending
+    assert "broadcast" in eventlog.records()[-1]
+
+
+def test_bad_time_is_refused(house):
+    broadcast(house, b"1@noon")
+    assert not house.device.sets
+    assert "bad broadcast time" in eventlog.records()[-1]
+
+
+def test_unsynchronised_clock_runs_at_once(house):
+    house.clock.synced = False
+    broadcast(house, b"1@" + stamp(SYNC_MS + 1000))
+    assert house.device.sets
+
+
+def test_pending_commands_are_bounded(house):
+    for idx in range(groups.MAX_PENDING + 2):
+        broadcast(house, b"1@" + stamp(SYNC_MS + 1000 + idx))
+    assert len(house.pending) == groups.MAX_PENDING
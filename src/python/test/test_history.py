@@ -0,0 +1,80 @@
+import pytest
+
+import history
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+def make(size, spill=0):
+    hist = history.History(size, spill)
+    hist.synced = True
+    return hist
+
+
+def drain(hist):
+    records = []
+    while True:
+        record = hist.pop()
+        if record is None:
+            return records
+        records.append(record)
+
+
+def fill(hist, clock, count):
+    for value in range(count):
+        hist.add(value % 4, value)
+        clock.advance(1000)
+
+
+def test_ring_keeps_the_last_records(clock):
+    hist = make(4)
+    fill(hist, clock, 6)
+    assert len(hist) == 4
+    records = drain(hist)
+    assert [value for _, _, value in records] == [2, 3, 4, 5]
+    assert [prop for _, prop, _ in records] == [2, 3, 0, 1]
+    assert records[0][0] + 3 == records[-1][0]
+    assert len(hist) == 0
+
+
+def test_spill_returns_oldest_first(clock):
+    hist = make(4, 40)
+    #ring, a partial batch and two written batches
+    count = 4 + 2 * history.SPILL_BATCH + 5
+    fill(hist, clock, count)
+    assert len(hist) == count
+    assert hist.file_count == 2 * history.SPILL_BATCH
+    assert [value for _, _, value in drain(hist)] == list(range(count))
+
+
+def test_full_spill_file_drops_oldest(clock):
+    spill = history.SPILL_BATCH + 4
+    hist = make(4, spill)
+    count = 4 + 3 * history.SPILL_BATCH + 3
+    fill(hist, clock, count)
+    assert hist.file_count == spill
+    kept = spill + hist.batch_count + 4
+    assert len(hist) == kept
+    assert [value for _, _, value in drain(hist)] == list(range(count - kept, count))
+
+
+def test_pop_between_adds(clock):
+    hist = make(4, 40)
+    fill(hist, clock, 30)
+    assert [hist.pop()[2] for _ in range(10)] == list(range(10))
+    for value in range(30, 60):
+        hist.add(0, value)
+    assert [value for _, _, value in drain(hist)] == list(range(10, 60))
+
+
+def test_measures_wait_for_the_clock(clock):
+    hist = history.History(4)
+    hist.add(0, 1)
+    assert len(hist) == 0
+    assert hist.pop() is None
+    hist.synced = True
+    hist.add(0, 2)
+    assert hist.pop()[2] == 2
@@ -11,7 +11,6 @@ if __name__ == "__main__":
     MQTT_ID = b"esp32_"+ ubinascii.hexlify(unique_id())
 
     mqtt = robust.MQTTClient(MQTT_ID, "192.168.2.42")
-    mqtt.connect()
 
     props_color = [ Property("color", "desired color RGB", "color", None, "rgb", "0,0,0", my_cb) ]
     dim_props = [ Property("chan-a", "Dimmer A", "float", None, "0:100", 0, my_cb), Property("chan-b", "Dimmer B", "integer", "%", "0:100", 0, my_cb), Property("chan-c", "Dimmer C", "integer", "%", "0:100", 0, my_cb), Property("chan-d", "Dimmer D", "integer", "%", "0:100", 0, my_cb) ]
@@ -20,5 +19,5 @@ if __name__ == "__main__":
     device = HomieDevice(mqtt, ubinascii.hexlify(unique_id()), nodes, "Multicontroler")
 
     while(True):
-        device.mqtt.check_msg()
+        device.main()
         time.sleep(.050)
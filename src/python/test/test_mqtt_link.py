@@ -0,0 +1,104 @@
+import errno
+
+import pytest
+
+import mqtt_link
+
+
+class Sock:
+    """Non blocking socket: what is written is kept, reads come from rx."""
+
+    def __init__(self):
+        self.written = bytearray()
+        self.rx = bytearray()
+
+    def write(self, data, size=None):
+        if isinstance(data, str):
+            data = data.encode()
+        self.written += data[:size] if size is not None else data
+
+    def read(self, size):
+        if not self.rx:
+            return None
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+
+class Client:
+    def __init__(self):
+        self.sock = Sock()
+        self.pid = 0
+
+
+def puback(pid):
+    return bytes((0x40, 0x02, pid >> 8, pid & 0xFF))
+
+
+def test_window_full_until_puback(clock):
+    mqtt = Client()
+    window = mqtt_link.PublishWindow(mqtt, 2)
+    assert window.publish("a", "1", True)
+    assert window.publish("b", "2", True)
+    assert not window.publish("c", "3", True)
+    assert window.free() == 0
+    mqtt.sock.rx += puback(1)
+    assert window.poll()
+    assert list(window.inflight) == [2]
+    assert window.publish("c", "3", True)
+
+
+def test_window_retries_with_dup_then_times_out(clock):
+    mqtt = Client()
+    window = mqtt_link.PublishWindow(mqtt, 2)
+    window.publish("a", "1", False)
+    assert mqtt.sock.written[0] == 0x32
+    for _ in range(mqtt_link.MAX_RETRIES):
+        mqtt.sock.written = bytearray()
+        clock.advance(mqtt_link.RETRY_MS)
+        window.poll()
+        #QoS 1 PUBLISH with the DUP flag
+        assert mqtt.sock.written[0] == 0x3A
+    clock.advance(mqtt_link.RETRY_MS)
+    with pytest.raises(OSError) as excinfo:
+        window.poll()
+    assert excinfo.value.args[0] == errno.ETIMEDOUT
+
+
+def test_window_resend_after_reconnection(clock):
+    mqtt = Client()
+    window = mqtt_link.PublishWindow(mqtt, 2)
+    window.publish("a", "1", True)
+    for _ in range(mqtt_link.MAX_RETRIES):
+        clock.advance(mqtt_link.RETRY_MS)
+        window.poll()
+    mqtt.sock = Sock()
+    window.resend()
+    assert mqtt.sock.written[0] == 0x3B
+    #a new connection gets its own retries
+    clock.advance(mqtt_link.RETRY_MS)
+    window.poll()
+    mqtt.sock.rx += puback(1)
+    window.poll()
+    assert not window.inflight
+
+
+def test_connack_read_in_parts(clock):
+    mqtt = Client()
+    link = mqtt_link.Connector(mqtt)
+    link.state = mqtt_link.WAIT_CONNACK
+    link.clean = False
+    link.deadline = clock.ms + mqtt_link.CONNECT_TIMEOUT_MS
+    assert link.step() is None
+    mqtt.sock.rx += b"\x20"
+    assert link.step() is None
+    assert link.state == mqtt_link.WAIT_CONNACK
+    mqtt.sock.rx += b"\x02\x01\x00"
+    assert link.step() == 1
+    assert link.state == mqtt_link.CONNECTED
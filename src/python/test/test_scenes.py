@@ -0,0 +1,59 @@
+import pytest
+from machine import Pin, PWM
+
+from sim import hw
+
+import main
+import transition
+
+MAX = transition.LEVEL_MAX
+
+
+@pytest.fixture
+def scenes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    hw.reset()
+    fader = transition.Fader()
+    dimmers = [main.Dimmer(name, PWM(Pin(pwm_pin), duty=0), bt_pin, fader)
+               for name, pwm_pin, bt_pin in (("A", 12, 32), ("B", 13, 33), ("C", 2, 25), ("D", 4, 26))]
+    yield main.SceneManager(dimmers, main.ColorManager(dimmers, fader), fader)
+    hw.reset()
+
+
+def targets(scenes):
+    return [dimmer.channel.target for dimmer in scenes.dimmers]
+
+
+def test_levels_set_every_channel(scenes):
+    assert scenes.set_levels(None, "50,,0,100,2000") == "50,,0,100"
+    assert targets(scenes) == [MAX // 2, 0, 0, MAX]
+    assert scenes.dimmers[0].channel.duration == 2000
+    assert scenes.set_levels(None, ",25") == ",25"
+    assert targets(scenes) == [MAX // 2, MAX // 4, 0, MAX]
+
+
+def test_stored_scene_is_recalled(scenes):
+    scenes.set_levels(None, "10,20,30,40,0")
+    assert scenes.store(None, "3")
+    stored = targets(scenes)
+    scenes.set_levels(None, "0,0,0,0,0")
+    assert scenes.recall(None, "3,500") == "3"
+    assert targets(scenes) == stored
+    assert scenes.dimmers[3].channel.duration == 500
+    #the scenes are kept on flash
+    assert scenes.load() == {"3": stored}
+
+
+def test_unknown_scene_is_not_recalled(scenes):
+    scenes.set_levels(None, "10,20,30,40,0")
+    assert scenes.recall(None, "7") is False
+    assert targets(scenes) == [int(level * MAX / 100) for level in (10, 20, 30, 40)]
+
+
+def test_scene_stops_the_cycler(scenes):
+    scenes.color_manager.set_cycler(None, "12")
+    assert scenes.color_manager.cycle
+    scenes.set_levels(None, ",,,50")
+    assert scenes.color_manager.cycle
+    scenes.set_levels(None, "50")
+    assert not scenes.color_manager.cycle
@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import pytest
+
+import eventlog
+import scheduler
+from sim import hw
+
+
+class Stop(Exception):
+    pass
+
+
+class Watchdog:
+    def __init__(self):
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(scheduler, "RESTART_MIN_MS", 10)
+    monkeypatch.setattr(scheduler, "RESTART_MAX_MS", 40)
+
+
+def run_for(tasks, seconds, *coros):
+    async def main():
+        try:
+            await asyncio.wait_for(tasks.run_jobs(0, *coros), seconds)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(main())
+
+
+def test_jobs_run_at_their_period():
+    calls = {"fast": 0, "slow": 0}
+
+    def count(name):
+        calls[name] += 1
+
+    tasks = scheduler.Scheduler()
+    tasks.every("fast", 10, count, "fast")
+    tasks.every("slow", 100, count, "slow")
+    run_for(tasks, 0.25)
+    assert 2 <= calls["slow"] <= 4
+    assert 15 <= calls["fast"] <= 27
+
+
+def test_returned_delay_runs_the_job_sooner():
+    calls = []
+
+    def poll():
+        calls.append(time.ticks_ms())
+        return 5
+
+    tasks = scheduler.Scheduler()
+    tasks.every("clock", 1000, poll)
+    run_for(tasks, 0.1)
+    assert len(calls) > 5
+
+
+def test_failing_job_backs_off_and_the_others_go_on():
+    calls = {"bad": 0, "good": 0}
+
+    def bad():
+        calls["bad"] += 1
+        raise OSError(5)
+
+    def good():
+        calls["good"] += 1
+
+    tasks = scheduler.Scheduler()
+    tasks.every("bad", 1, bad)
+    tasks.every("good", 10, good)
+    run_for(tasks, 0.3)
+    #10, 20 then 40 ms apart
+    assert 4 <= calls["bad"] <= 10
+    assert calls["good"] >= 20
+    assert tasks.backoff[0] == 40
+    assert any(["job bad failed" in text for text in eventlog.records()])
+
+
+def test_coros_run_next_to_the_jobs_and_register_jobs():
+    calls = []
+    tasks = scheduler.Scheduler()
+    tasks.every("first", 10, calls.append, "first")
+
+    async def stage():
+        await scheduler.sleep_ms(20)
+        first = len(tasks.jobs)
+        tasks.every("later", 10, calls.append, "later")
+        await tasks.run_jobs(first)
+
+    run_for(tasks, 0.15, stage())
+    assert "later" in calls
+    assert calls[0] == "first"
+
+
+def test_supervise_feeds_only_healthy_jobs(clock):
+    async def main():
+        tasks = scheduler.Scheduler(watchdog_ms=60000)
+        tasks.wdt = Watchdog()
+        tasks.every("mqtt", 50, lambda: None)
+        tasks.every("sensors", 200, lambda: None)
+        tasks.supervised = clock.ms
+        tasks.due[:] = [clock.ms, clock.ms + 100]
+        clock.advance(1000)
+        tasks.supervise()
+        assert tasks.wdt.feeds == 1
+        #the mqtt task stopped
+        clock.advance(scheduler.STALL_MS)
+        tasks.due[1] = clock.ms
+        tasks.supervise()
+        assert tasks.wdt.feeds == 1
+        assert tasks.generation == [1, 0]
+        assert tasks.due[0] == clock.ms
+        assert "job mqtt stalled" in eventlog.records()[-1]
+        #the restarted task runs
+        await asyncio.sleep(0)
+        assert tasks.due[0] is not None
+        clock.advance(1000)
+        tasks.due[1] = clock.ms
+        tasks.supervise()
+        assert tasks.wdt.feeds == 2
+    asyncio.run(main())
+
+
+def test_blocked_loop_restarts_nothing(clock):
+    tasks = scheduler.Scheduler(watchdog_ms=60000)
+    tasks.wdt = Watchdog()
+    tasks.every("mqtt", 50, lambda: None)
+    tasks.supervised = tasks.due[0] = clock.ms
+    clock.advance(60000 // 4 + scheduler.STALL_MS + 1)
+    tasks.supervise()
+    assert tasks.generation == [0]
+    assert tasks.wdt.feeds == 1
+
+
+def test_start_creates_the_watchdog(monkeypatch):
+    hw.reset()
+    tasks = scheduler.Scheduler(watchdog_ms=400)
+
+    async def stop():
+        await scheduler.sleep_ms(250)
+        raise Stop
+
+    with pytest.raises(Stop):
+        tasks.start(stop())
+    assert hw.wdt["timeout"] == 400
+    assert hw.wdt["feeds"] >= 2
+    assert [job[0] for job in tasks.jobs] == ["watchdog"]
@@ -0,0 +1,49 @@
+import pytest
+
+from sim import hw
+
+import env_sensors
+import eventlog
+import main
+
+ROMS = [bytearray(b"\x28\x00\x00\x00\x00\x00\x00\x01"), bytearray(b"\x28\x00\x00\x00\x00\x00\x00\x02")]
+
+
+@pytest.fixture(autouse=True)
+def board(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for key in ("dht", "ds1820", "bme280"):
+        monkeypatch.setitem(main.config, key, False)
+    monkeypatch.setitem(main.config, "esp32", True)
+    hw.reset()
+    yield
+    hw.reset()
+
+
+def test_bme280(monkeypatch):
+    monkeypatch.setitem(main.config, "bme280", True)
+    hw.i2c_devices.extend([0x3C, 0x76, 0x77])
+    nodes = main.sensor_nodes()
+    assert [type(node) for node in nodes] == [env_sensors.EnvironmentBME280] * 2
+
+
+def test_failing_bme280_is_left_out(monkeypatch):
+    monkeypatch.setitem(main.config, "bme280", True)
+    hw.i2c_devices.extend([0x76, 0x77])
+    hw.sensor_failures["bme280_setup"] = 1
+    nodes = main.sensor_nodes()
+    assert [node.driver.address for node in nodes] == [0x77]
+    assert "EnvironmentBME280 setup failed" in eventlog.records()[-1]
+
+
+def test_failing_onewire_bus_gives_no_node(monkeypatch):
+    monkeypatch.setitem(main.config, "ds1820", True)
+    hw.onewire_roms.extend(ROMS)
+    hw.sensor_failures["onewire_scan"] = 1
+    assert main.sensor_nodes() == []
+    assert "sensor bus setup failed" in eventlog.records()[-1]
+    assert len(main.sensor_nodes()) == 2
+
+
+def test_no_sensor():
+    assert main.sensor_nodes() == []
@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_outage_and_malformed_set(tmp_path):
+    """main.py reconnects after a broker outage, drops a malformed set and
+    still applies the next one."""
+    log_path = str(tmp_path / "publications.jsonl")
+    result = subprocess.run([sys.executable, "-m", "sim.run", "--seconds", "9", "--outage", "2+2",
+                             "--set", "dimmer/chan-a=abc@6", "--set", "dimmer/chan-b=40@6.5",
+                             "--log", log_path, "--workdir", str(tmp_path)],
+                            cwd=SRC_DIR, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stdout
+    with open(log_path) as log_file:
+        records = [json.loads(line) for line in log_file]
+    device = [record for record in records if record["client_id"] != "sim"]
+    states = [(record["time"], record["payload"]) for record in device if record["topic"].endswith("/$state")]
+    assert [payload for _, payload in states] == ["init", "ready", "lost", "ready"]
+    assert states[-1][0] > 4
+    echoes = {record["topic"].rsplit("/", 1)[-1]: record["payload"] for record in device
+              if record["topic"].endswith("/chan-a") or record["topic"].endswith("/chan-b")}
+    assert echoes["chan-b"] == "40"
+    assert echoes.get("chan-a") != "abc"
+    with open(str(tmp_path / "log.txt")) as log_file:
+        log = log_file.read()
+    assert "dropped" in log and "chan-a/set" in log
+    assert "job " not in log
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+import snapshot
+
+
+def make(levels, cycle=0):
+    dimmers = [SimpleNamespace(channel=SimpleNamespace(target=level)) for level in levels]
+    return snapshot.Snapshot(dimmers, SimpleNamespace(cycle=cycle))
+
+
+def test_pack_unpack():
+    snap = make([0, 1, 0x8000, 0xFFFF], cycle=2)
+    buf = bytearray(snap.size + 2)
+    snap.pack(buf)
+    assert snap.unpack(buf) == ((0, 1, 0x8000, 0xFFFF), 2)
+
+
+def test_corrupted_state_is_rejected():
+    snap = make([100, 200])
+    buf = bytearray(snap.size + 2)
+    snap.pack(buf)
+    buf[4] ^= 1
+    assert snap.unpack(buf) is None
+    assert snap.unpack(b"") is None
+    assert snap.unpack(bytes(buf[:-1])) is None
+
+
+def test_other_channel_count_is_rejected():
+    data = bytearray(make([100, 200]).size + 2)
+    make([100, 200]).pack(data)
+    snap = make([100, 200, 300])
+    assert snap.unpack(data) is None
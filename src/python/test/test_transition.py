@@ -0,0 +1,62 @@
+from machine import PWM, Pin
+
+import transition
+from transition import LEVEL_MAX
+
+
+def test_level_to_duty_bounds():
+    assert transition.level_to_duty(0) == 0
+    assert transition.level_to_duty(LEVEL_MAX) == transition.DUTY_MAX
+    duties = [transition.level_to_duty(level) for level in range(0, LEVEL_MAX + 1, 97)]
+    assert duties == sorted(duties)
+
+
+def test_duty_to_level_is_the_lowest_level():
+    for duty in (1, 10, 512, transition.DUTY_MAX):
+        level = transition.duty_to_level(duty)
+        assert transition.level_to_duty(level) >= duty
+        assert transition.level_to_duty(level - 1) < duty
+
+
+def test_fade(clock):
+    fader = transition.Fader()
+    chan = fader.channel(PWM(Pin(12)))
+    fader.fade(chan, LEVEL_MAX, 1000)
+    levels = []
+    for _ in range(1000 // transition.FRAME_MS - 1):
+        clock.advance(transition.FRAME_MS)
+        fader.frame()
+        levels.append(chan.level)
+    assert chan.fading
+    assert levels == sorted(levels)
+    assert abs(levels[1000 // transition.FRAME_MS // 2 - 1] - LEVEL_MAX // 2) < 64
+    clock.advance(transition.FRAME_MS)
+    fader.frame()
+    assert not chan.fading
+    assert chan.level == LEVEL_MAX
+    assert chan.pwm.duty() == transition.DUTY_MAX
+
+
+def test_fade_down_and_clamped(clock):
+    fader = transition.Fader()
+    chan = fader.channel(PWM(Pin(13)))
+    chan.set(LEVEL_MAX)
+    fader.fade(chan, -5, 10 * transition.MAX_FADE_MS)
+    assert chan.target == 0
+    assert chan.duration == transition.MAX_FADE_MS
+    clock.advance(transition.MAX_FADE_MS // 4)
+    fader.frame()
+    assert abs(chan.level - LEVEL_MAX * 3 // 4) < 64
+    clock.advance(transition.MAX_FADE_MS)
+    fader.frame()
+    assert chan.level == 0
+    assert chan.pwm.duty() == 0
+
+
+def test_zero_duration_is_immediate(clock):
+    fader = transition.Fader()
+    chan = fader.channel(PWM(Pin(14)))
+    fader.fade(chan, 1000, 0)
+    fader.frame()
+    assert chan.level == 1000
+    assert not chan.fading
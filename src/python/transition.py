@@ -0,0 +1,93 @@
+import time
+from array import array
+from micropython import const
+
+FRAME_MS = const(20)
+MAX_FADE_MS = const(60000)
+
+#levels are perceptual brightness on 16 bits, PWM duty is on 10 bits
+LEVEL_MAX = const(0xFFFF)
+DUTY_MAX = const(1023)
+GAMMA = 2.2
+
+#duty of level idx << 8, one more entry so the interpolation can always read idx + 1
+GAMMA_LUT = array("H", [int(DUTY_MAX * (idx / 256) ** GAMMA + 0.5) for idx in range(257)])
+
+
+def level_to_duty(level):
+    if level >= LEVEL_MAX:
+        return DUTY_MAX
+    idx = level >> 8
+    low = GAMMA_LUT[idx]
+    return low + ((GAMMA_LUT[idx + 1] - low) * (level & 0xFF) >> 8)
+
+
+def duty_to_level(duty):
+    """Lowest level giving at least duty."""
+    low, high = 0, LEVEL_MAX
+    while low < high:
+        mid = (low + high) >> 1
+        if level_to_duty(mid) < duty:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+class Channel:
+    def __init__(self, pwm):
+        self.pwm = pwm
+        self.level = 0
+        self.start = 0
+        self.target = 0
+        self.begin = 0
+        self.duration = 0
+        self.fading = False
+
+    def set(self, level):
+        """Moves to level at once, without fading."""
+        self.level = self.target = min(max(level, 0), LEVEL_MAX)
+        self.fading = False
+        self.pwm.duty(level_to_duty(self.level))
+
+    def sync(self):
+        """Takes the level back from the PWM after someone else (the cycler) drove it."""
+        self.level = self.target = duty_to_level(self.pwm.duty())
+        self.fading = False
+
+
+class Fader:
+    """Moves channels to their target level in duration ms.
+
+    frame() is meant to be called every FRAME_MS, it interpolates in fixed
+    point and maps levels through GAMMA_LUT, all the channels set before a
+    frame change in that frame.
+    """
+
+    def __init__(self):
+        self.channels = []
+
+    def channel(self, pwm):
+        chan = Channel(pwm)
+        self.channels.append(chan)
+        return chan
+
+    def fade(self, chan, target, duration):
+        chan.start = chan.level
+        chan.target = min(max(target, 0), LEVEL_MAX)
+        chan.begin = time.ticks_ms()
+        chan.duration = min(max(duration, 0), MAX_FADE_MS)
+        chan.fading = True
+
+    def frame(self):
+        now = time.ticks_ms()
+        for chan in self.channels:
+            if chan.fading:
+                elapsed = time.ticks_diff(now, chan.begin)
+                if elapsed >= chan.duration:
+                    chan.level = chan.target
+                    chan.fading = False
+                else:
+                    #elapsed fraction on 12 bits keeps the products in small ints
+                    chan.level = chan.start + ((chan.target - chan.start) * (elapsed * 4096 // chan.duration) >> 12)
+                chan.pwm.duty(level_to_duty(chan.level))